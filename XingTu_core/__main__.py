@@ -1,6 +1,10 @@
 import argparse
+import multiprocessing
+import sys
 from config import XTConfig
 from progress import progress
+import events
+import profiler
 import os
 
 
@@ -8,11 +12,35 @@ parser = argparse.ArgumentParser(description="多功能图像处理工具")
 parser.add_argument("-b", "--BASE64", help="base64 string for config json", type=str)
 parser.add_argument("-j", "--JSON", help="JSON string for config", type=str)
 parser.add_argument("-y", "--YAML", help="yaml config file path", type=str)
-
-args = parser.parse_args()
+parser.add_argument("-m", "--MANIFEST", help="JSON-lines input manifest file, '-' for stdin", type=str)
+parser.add_argument("-e", "--EVENTS", help="write JSON-lines progress and stage timing events to this file, "
+                                         "'-' for stderr", type=str)
+parser.add_argument("-p", "--PROFILE", "--profile", dest="PROFILE", type=str,
+                    help="record a Chrome trace (chrome://tracing, Perfetto) of the run to this file")
+parser.add_argument("--PROFILE_TORCH", "--profile-torch", dest="PROFILE_TORCH", action="store_true",
+                    help="with --PROFILE, also record torch profiler data of the final2x inference")
+parser.add_argument("-s", "--SERVER", help="run as a long-lived JSON-lines server on stdin/stdout",
+                    action="store_true")
 
 
 def main():
+    # 参数需在 main 中解析: 批处理子进程(spawn)会重新导入本模块
+    args = parser.parse_args()
+    events.configure(args.EVENTS)
+    if args.PROFILE is None:
+        return run(args)
+    profiler.start(args.PROFILE, args.PROFILE_TORCH)
+    try:
+        return run(args)
+    finally:
+        profiler.stop()
+
+
+def run(args: argparse.Namespace):
+    if args.SERVER:
+        from server import serve
+        serve()
+        return True
     config: XTConfig
     if args.BASE64 is not None:
         config = XTConfig.from_base64(str(args.BASE64))
@@ -20,9 +48,11 @@ def main():
         config = XTConfig.from_json_str(str(args.JSON))
     elif args.YAML is not None:
         config = XTConfig.from_yaml(str(args.YAML))
+    if args.MANIFEST is not None and config.command != "stream" and config.get_command_config() is not None:
+        config.get_command_config().manifest = args.MANIFEST
     return progress(config)
 
 
 if __name__ == "__main__":
-    main()
-    
+    multiprocessing.freeze_support()  # pyinstaller 打包后使用进程池所必需
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,161 @@
+from PIL import Image
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Iterator, List, Optional, Tuple
+import os
+
+from events import stage
+from resize import decode_reduced
+
+# 支持动画的输出格式: 配置中的格式名 -> Pillow 格式名，png 输出为 APNG
+ANIMATED_FORMATS = {'gif': 'GIF', 'webp': 'WEBP', 'png': 'PNG', 'apng': 'PNG'}
+
+# 逐帧转换的线程数，Pillow 的缩放、量化与编码在执行时会释放 GIL
+_FRAME_WORKERS = min(4, os.cpu_count() or 1)
+
+# GIF 帧量化时保留给透明色的调色板索引
+_GIF_TRANSPARENT_INDEX = 255
+
+Frame = Tuple[Image.Image, int]  # (帧图像, 显示时长毫秒)
+
+
+def is_animated(img: Image.Image) -> bool:
+    """是否为多帧的 GIF、WebP、APNG 等动画图片"""
+    return getattr(img, 'is_animated', False) and getattr(img, 'n_frames', 1) > 1
+
+
+def supports_animation(target_format: str) -> bool:
+    return target_format.lower() in ANIMATED_FORMATS
+
+
+def iter_frames(img: Image.Image) -> Iterator[Frame]:
+    """
+    逐帧解码，每次只解码下一帧
+
+    Pillow 对 GIF、WebP、APNG 的帧已经按处置方式合成为完整画面，这里统一复制为 RGBA，
+    之后各帧相互独立，可以并发处理。
+    """
+    for index in range(img.n_frames):
+        img.seek(index)
+        with stage('decode', frame=index):
+            frame = img.convert('RGBA')
+        yield frame, img.info.get('duration', 100)
+
+
+def map_frames(frames: Iterator[Frame], convert: Callable[[Image.Image], Any],
+               workers: int = _FRAME_WORKERS) -> Iterator[Tuple[Any, int]]:
+    """
+    并发转换各帧，按原顺序产出结果
+
+    同时在途的帧数限制为 workers 的两倍，解码领先转换的帧数有上限，内存占用不随帧数增长。
+    """
+    if workers <= 1:
+        for frame, duration in frames:
+            yield convert(frame), duration
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending: Deque[Tuple[Future, int]] = deque()
+        for frame, duration in frames:
+            if len(pending) >= workers * 2:
+                future, frame_duration = pending.popleft()
+                yield future.result(), frame_duration
+            pending.append((executor.submit(convert, frame), duration))
+        while pending:
+            future, frame_duration = pending.popleft()
+            yield future.result(), frame_duration
+
+
+def to_gif_frame(frame: Image.Image) -> Image.Image:
+    """
+    将 RGBA 帧量化为 GIF 调色板帧，半透明以下的像素映射为透明色
+
+    GIF 保存时 Pillow 会逐帧串行量化，在这里提前并发完成。
+    """
+    alpha = frame.getchannel('A')
+    if alpha.getextrema()[0] >= 128:
+        return frame.convert('RGB').quantize(256)
+    paletted = frame.convert('RGB').quantize(_GIF_TRANSPARENT_INDEX)
+    paletted.paste(_GIF_TRANSPARENT_INDEX, mask=alpha.point(lambda a: 255 if a < 128 else 0))
+    paletted.info['transparency'] = _GIF_TRANSPARENT_INDEX
+    return paletted
+
+
+def convert_frame(frame: Image.Image, target_format: str) -> Image.Image:
+    """按目标格式转换单帧"""
+    if ANIMATED_FORMATS[target_format.lower()] == 'GIF':
+        return to_gif_frame(frame)
+    return frame
+
+
+def read_animation(img: Image.Image, convert: Callable[[Image.Image], Any],
+                   max_size: Optional[int] = None) -> Tuple[List[Any], List[int]]:
+    """
+    逐帧解码动画并发地缩放、转换各帧
+
+    Args:
+        img: 打开的动画图片
+        convert: 单帧的转换函数
+        max_size: 帧的最长边上限(像素)
+
+    Returns:
+        (各帧的转换结果, 各帧显示时长)
+    """
+    results, durations = [], []
+    for result, duration in map_frames(iter_frames(img), lambda frame: convert(decode_reduced(frame, max_size))):
+        results.append(result)
+        durations.append(duration)
+    return results, durations
+
+
+def save_animation(frames: List[Image.Image], durations: List[int], output_file: str, target_format: str,
+                   loop: Optional[int] = 0, quality: Optional[int] = None, **options) -> None:
+    """
+    将各帧保存为动画，保留每帧时长与循环次数
+
+    Args:
+        frames: 已按目标格式转换的完整帧
+        durations: 每帧显示时长(毫秒)
+        output_file: 输出文件路径
+        target_format: gif / webp / png(apng)
+        loop: 循环次数，0 为无限循环，None 为只播放一次(GIF 原图没有循环设置时)
+        quality: WebP 的编码质量
+        options: 透传给编码器的其他参数
+    """
+    pil_format = ANIMATED_FORMATS[target_format.lower()]
+    params = {'save_all': True, 'append_images': frames[1:], 'duration': durations}
+    if loop is not None:
+        params['loop'] = loop
+    elif pil_format != 'GIF':
+        params['loop'] = 1  # WebP、APNG 的 loop 默认为 0(无限循环)，只播放一次需显式设置为 1
+    if pil_format == 'GIF':
+        params['disposal'] = 2  # 每帧都是完整画面，显示下一帧前恢复为背景，透明区域不会残留上一帧
+    elif pil_format == 'PNG':
+        params['disposal'] = 0
+        params['blend'] = 0  # 直接覆盖，不与上一帧混合
+    elif quality is not None:
+        params['quality'] = quality
+    frames[0].save(output_file, format=pil_format, **{**params, **options})
+
+
+def convert_animation(img: Image.Image, output_files: List[str], targets: List[Any],
+                      max_size: Optional[int] = None) -> None:
+    """
+    逐帧解码动画并转换为多个动画目标格式
+
+    解码在当前线程中按顺序进行，各帧的缩放与量化并发执行，最后按原时长与循环次数重新组装。
+
+    Args:
+        img: 打开的动画图片
+        output_files: 输出文件路径列表，与 targets 一一对应
+        targets: FormatTarget 列表，格式均需支持动画
+        max_size: 帧的最长边上限(像素)
+    """
+    loop = img.info.get('loop')
+    results, durations = read_animation(
+        img, lambda frame: [convert_frame(frame, target.format) for target in targets], max_size)
+
+    for i, (output_file, target) in enumerate(zip(output_files, targets)):
+        frames = [result[i] for result in results]
+        with stage('encode', format=target.format.lower(), frames=len(frames)) as record:
+            save_animation(frames, durations, output_file, target.format, loop, target.quality, **target.options)
+            record['bytes_out'] = os.path.getsize(output_file)
@@ -0,0 +1,225 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from pydantic import BaseModel
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import multiprocessing
+import os
+import time
+
+import events
+import model_store
+import profiler
+
+# 一个批处理任务: (单文件处理函数, 输入文件路径, 其余位置参数)
+# 处理函数需定义在模块顶层，以便在子进程中被 pickle
+BatchTask = Tuple[Callable[..., Any], str, tuple]
+
+
+# 进程池在多次批处理之间复用，常驻服务模式下子进程中的模型与会话可以保持加载状态。
+# 子进程只在创建时继承环境变量，模型仓库设置改变时需要重建进程池
+_executors: Dict[Tuple[int, tuple], ProcessPoolExecutor] = {}
+
+
+def _executor_key(workers: int) -> Tuple[int, tuple]:
+    return workers, tuple(os.environ.get(name) for name in model_store.ENV_VARS)
+
+
+def get_executor(workers: int) -> ProcessPoolExecutor:
+    """获取(或创建)指定进程数的共享进程池"""
+    key = _executor_key(workers)
+    executor = _executors.get(key)
+    if executor is None:
+        for other in _executors.values():
+            other.shutdown(wait=True)
+        _executors.clear()
+        # 使用 spawn 启动子进程: fork 会复制已导入的 rembg(pymatting)等模块的线程状态，进程池退出时无法结束
+        executor = _executors[key] = ProcessPoolExecutor(max_workers=workers,
+                                                         mp_context=multiprocessing.get_context("spawn"))
+    return executor
+
+
+def discard_executor(workers: int) -> None:
+    """丢弃已损坏的进程池(子进程异常退出)，下次 get_executor 时重新创建"""
+    executor = _executors.pop(_executor_key(workers), None)
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class FileResult(BaseModel):
+    """单个文件的处理结果"""
+    input_path: str
+    output_paths: List[str] = []
+    success: bool
+    error: Optional[str] = None
+    elapsed: float = 0.0
+    skipped: bool = False  # 增量模式下输入未改变，沿用上次的输出
+    stages: List[Dict[str, Any]] = []  # 开启事件输出时各处理阶段的耗时记录
+
+
+class BatchReport(BaseModel):
+    """一次批处理的汇总结果"""
+    command: str
+    workers: int = 1
+    elapsed: float = 0.0
+    results: List[FileResult] = []
+
+    @property
+    def succeeded(self) -> int:
+        return sum(1 for r in self.results if r.success)
+
+    @property
+    def skipped(self) -> int:
+        return sum(1 for r in self.results if r.skipped)
+
+    @property
+    def failed(self) -> int:
+        return len(self.results) - self.succeeded
+
+    @property
+    def throughput(self) -> float:
+        """每秒处理的文件数"""
+        return len(self.results) / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __bool__(self) -> bool:
+        return len(self.results) > 0 and self.failed == 0
+
+
+def _as_output_paths(output: Any) -> List[str]:
+    if output is None or output is False or output is True:
+        return []
+    if isinstance(output, (list, tuple)):
+        return [str(o) for o in output if o]
+    return [str(output)]
+
+
+def run_task(func: Callable[..., Any], input_path: str, args: tuple) -> FileResult:
+    """执行单个任务并计时，异常会被转换为失败结果而不是向上抛出"""
+    start = time.perf_counter()
+    with events.collect_stages() as stages:
+        try:
+            output_paths = _as_output_paths(func(input_path, *args))
+            error = None if output_paths else "处理失败"
+        except Exception as e:
+            output_paths, error = [], str(e)
+    profiler.flush()
+    return FileResult(
+        input_path=str(input_path),
+        output_paths=output_paths,
+        success=error is None,
+        error=error,
+        elapsed=time.perf_counter() - start,
+        stages=stages,
+    )
+
+
+def _broken_result(input_path: str) -> FileResult:
+    return FileResult(input_path=input_path, success=False, error="处理进程异常退出")
+
+
+def iter_results(tasks: Iterable[BatchTask], workers: int = 1, planner=None) -> Iterator[FileResult]:
+    """
+    按完成顺序逐个产出任务结果
+
+    workers <= 1 时在当前进程中顺序执行；否则使用进程池，
+    同时在途的任务数限制为 workers 的两倍，因此 tasks 可以是任意长度的惰性迭代器。
+
+    :param planner: planner.JobPlanner，按文件头估算各任务的内存，同时运行的任务预计内存之和不超过预算；
+        超出预算的任务等到其他任务完成后单独运行
+    """
+    if workers <= 1:
+        for func, input_path, args in tasks:
+            yield run_task(func, input_path, args)
+        return
+
+    task_iter = iter(tasks)
+    max_in_flight = workers * 2
+    executor = get_executor(workers)
+    pending: Dict[Future, Tuple[str, float]] = {}
+    next_task: Optional[Tuple[BatchTask, float]] = None
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < max_in_flight:
+            if next_task is None:
+                try:
+                    task = next(task_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                next_task = (task, planner.estimate_mb(task[1]) if planner is not None else 0.0)
+            (func, input_path, args), memory_mb = next_task
+            if planner is not None:
+                if pending and sum(mb for _, mb in pending.values()) + memory_mb > planner.budget_mb:
+                    break  # 等待在途任务完成后再提交
+                if memory_mb > planner.budget_mb:
+                    events.emit("over_budget", input_path=str(input_path), memory_mb=round(memory_mb, 1),
+                                budget_mb=planner.budget_mb)  # 单独运行
+            pending[executor.submit(run_task, func, input_path, args)] = (str(input_path), memory_mb)
+            next_task = None
+        if not pending:
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        broken = False
+        for future in done:
+            input_path, _ = pending.pop(future)
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                broken = True
+                yield _broken_result(input_path)
+        if broken:
+            # 子进程异常退出(内存不足、解码器崩溃等)后进程池不可再用: 在途任务均记为失败，
+            # 其余任务提交到新的进程池
+            wait(pending)
+            for future, (input_path, _) in pending.items():
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    yield _broken_result(input_path)
+            pending.clear()
+            discard_executor(workers)
+            executor = get_executor(workers)
+
+
+def _skip_unchanged(tasks: Iterable[BatchTask], incremental, report: BatchReport,
+                    start: float) -> Iterator[BatchTask]:
+    for task in tasks:
+        outputs = incremental.unchanged(task[1])
+        if outputs is None:
+            yield task
+        else:
+            result = FileResult(input_path=str(task[1]), output_paths=outputs, success=True, skipped=True)
+            report.results.append(result)
+            events.emit_file(report.command, result, len(report.results), time.perf_counter() - start)
+
+
+def run_batch(command: str, tasks: Iterable[BatchTask], workers: int = 1, incremental=None,
+              planner=None, total: Optional[int] = None) -> BatchReport:
+    """
+    执行一批任务并输出汇总的吞吐信息
+
+    :param incremental: IncrementalManifest，跳过未改变的输入并记录处理成功的文件
+    :param planner: planner.JobPlanner，按预计内存调度任务
+    :param total: 任务总数(BaseConfig.input_total)，未知时为 None，batch_start 事件中不包含 total
+    """
+    report = BatchReport(command=command, workers=workers)
+    start = time.perf_counter()
+    events.emit("batch_start", command=command, workers=workers, **({} if total is None else {"total": total}))
+    if incremental is not None:
+        tasks = _skip_unchanged(tasks, incremental, report, start)
+    try:
+        for result in iter_results(tasks, workers, planner):
+            report.results.append(result)
+            if incremental is not None and result.success:
+                incremental.record(result.input_path, result.output_paths)
+            events.emit_file(command, result, len(report.results), time.perf_counter() - start)
+    finally:
+        if incremental is not None:
+            incremental.save()
+    report.elapsed = time.perf_counter() - start
+    events.emit("batch_end", command=command, files=len(report.results), succeeded=report.succeeded,
+                failed=report.failed, skipped=report.skipped, elapsed=report.elapsed,
+                throughput=report.throughput, peak_rss_mb=events.peak_rss_mb())
+    skipped = f", 跳过未改变 {report.skipped}" if incremental is not None else ""
+    print(f"批处理完成: 共 {len(report.results)} 个文件, 成功 {report.succeeded}, 失败 {report.failed}{skipped}, "
+          f"耗时 {report.elapsed:.2f} 秒, 吞吐 {report.throughput:.2f} 张/秒 (进程数 {workers})")
+    return report
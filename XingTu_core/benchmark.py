@@ -0,0 +1,248 @@
+"""
+性能基准测试: 使用合成图片运行 format、compress、remove_bg、final2x，输出可对比的 JSON 报告
+
+不需要网络和 GPU: final2x 在 CPU 上使用小模型，本地没有权重时使用随机初始化的权重(不影响耗时)；
+remove_bg 的模型文件不存在时跳过该命令。每个命令在独立的子进程中运行，内存峰值互不影响。
+
+用法:
+    python XingTu_core/benchmark.py -o bench.json
+    python XingTu_core/benchmark.py -o bench.json --commands format compress --sizes 512 2048 --repeat 5
+    python XingTu_core/benchmark.py -o new.json --compare base.json --threshold 0.1   # 吞吐下降超过 10% 时返回非零退出码
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from events import peak_rss_mb
+
+COMMANDS = ["format", "compress", "remove_bg", "final2x"]
+MODES = ["RGB", "RGBA", "L", "P"]
+
+FINAL2X_MODEL = "RealESRGAN_AniScale_2_Compact_2x.pth"
+REMOVE_BG_MODEL = "u2netp"
+
+
+def make_images(image_dir: str, sizes: List[int], modes: List[str]) -> List[str]:
+    """
+    生成合成测试图片: 渐变叠加噪声，压缩率接近真实照片
+
+    :return: 图片路径列表
+    """
+    rng = np.random.default_rng(0)
+    paths = []
+    for size in sizes:
+        y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+        base = np.stack([x, y, (x + y) / 2], axis=-1) * 200
+        rgb = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+        for mode in modes:
+            img = Image.fromarray(rgb, "RGB")
+            if mode == "RGBA":
+                alpha = (np.hypot(x - 0.5, y - 0.5) < 0.4).astype(np.uint8) * 255
+                img.putalpha(Image.fromarray(alpha, "L"))
+            elif mode == "P":
+                img = img.quantize(256)
+            else:
+                img = img.convert(mode)
+            path = os.path.join(image_dir, f"{size}_{mode}.png")
+            img.save(path)
+            paths.append(path)
+    return paths
+
+
+def _use_random_weights(model_name: str) -> bool:
+    """本地没有超分模型权重时改用随机初始化的权重，返回是否使用了随机权重"""
+    from ccrestoration.arch import SRVGGNetCompact
+    from ccrestoration.cache_models import CACHE_PATH
+    from ccrestoration.config import CONFIG_REGISTRY
+    import torch
+
+    cfg = CONFIG_REGISTRY.get(model_name)
+    if cfg.path is not None or os.path.isfile(os.path.join(CACHE_PATH, cfg.name)):
+        return False
+    torch.manual_seed(0)
+    model = SRVGGNetCompact(num_in_ch=cfg.num_in_ch, num_out_ch=cfg.num_out_ch, upscale=cfg.scale,
+                            num_feat=cfg.num_feat, num_conv=cfg.num_conv, act_type=cfg.act_type)
+    weights = os.path.join(tempfile.mkdtemp(prefix="xingtu-bench-"), cfg.name)
+    torch.save({"params": model.state_dict()}, weights)
+    cfg.path = weights
+    return True
+
+
+def _remove_bg_available(model_name: str) -> bool:
+    from rembg.sessions import sessions_class
+
+    session_class = next(sc for sc in sessions_class if sc.name() == model_name)
+    return os.path.isfile(os.path.join(session_class.u2net_home(), f"{model_name}.onnx"))
+
+
+def build_config(command: str, images: List[str], output_path: str, workers: int) -> Dict[str, Any]:
+    base = {"input_path": images, "output_path": output_path, "workers": workers}
+    if command == "format":
+        return {"command": command, "formatConfig": {**base, "targets": [{"format": "webp"}, {"format": "jpg"}]}}
+    if command == "compress":
+        return {"command": command, "compressConfig": {**base, "target_format": "jpg", "quality": 85}}
+    if command == "remove_bg":
+        return {"command": command, "removeBgConfig": {**base, "model": REMOVE_BG_MODEL}}
+    return {"command": command, "final2xConfig": {**base, "pretrained_model_name": FINAL2X_MODEL,
+                                                  "device": "cpu", "target_scale": 2}}
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    index = (len(values) - 1) * q
+    low, high = int(index), min(int(index) + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (index - low)
+
+
+def run_command(command: str, images: List[str], repeat: int, workers: int) -> Dict[str, Any]:
+    """
+    在当前进程中重复运行一个命令
+
+    第一次运行包含模型加载等冷启动开销，单独记录；延迟分位数与吞吐取自之后的运行。
+    """
+    from config import XTConfig
+    from progress import progress
+
+    result: Dict[str, Any] = {"files": len(images), "workers": workers}
+    if command == "final2x":
+        result["random_weights"] = _use_random_weights(FINAL2X_MODEL)
+    if command == "remove_bg" and not _remove_bg_available(REMOVE_BG_MODEL):
+        return {"skipped": f"rembg model {REMOVE_BG_MODEL} is not available offline"}
+
+    runs = []
+    latencies: List[float] = []
+    for i in range(repeat + 1):
+        output_path = tempfile.mkdtemp(prefix="xingtu-bench-out-")
+        try:
+            start = time.perf_counter()
+            report = progress(XTConfig(**build_config(command, images, output_path, workers)))
+            elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(output_path, ignore_errors=True)
+        if not report:
+            raise RuntimeError(f"{command} failed: " + "; ".join(
+                f"{r.input_path}: {r.error}" for r in report.results if not r.success))
+        if i == 0:
+            result["cold_elapsed"] = elapsed
+            continue
+        runs.append(elapsed)
+        latencies.extend(r.elapsed for r in report.results)
+
+    result.update({
+        "runs": runs,
+        "throughput": len(images) / statistics.median(runs),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p90": percentile(latencies, 0.9),
+        "latency_p99": percentile(latencies, 0.99),
+        "peak_rss_mb": peak_rss_mb(),
+    })
+    return result
+
+
+def environment() -> Dict[str, Any]:
+    versions = {}
+    for module in ("PIL", "numpy", "cv2", "onnxruntime", "rembg", "torch", "ccrestoration", "pillow_heif"):
+        try:
+            versions[module] = getattr(__import__(module), "__version__", "unknown")
+        except ImportError:
+            versions[module] = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "versions": versions,
+    }
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> bool:
+    """输出与基线的吞吐对比，返回是否没有超过阈值的性能回退"""
+    ok = True
+    print(f"{'命令':<10} {'基线(张/秒)':>12} {'当前(张/秒)':>12} {'变化':>8}")
+    for command, current in report["results"].items():
+        base = baseline.get("results", {}).get(command)
+        if not base or "throughput" not in base or "throughput" not in current:
+            continue
+        change = current["throughput"] / base["throughput"] - 1
+        regressed = change < -threshold
+        ok = ok and not regressed
+        print(f"{command:<10} {base['throughput']:>12.2f} {current['throughput']:>12.2f} {change:>+8.1%}"
+              + ("  性能回退" if regressed else ""))
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="XingTu-core 性能基准测试")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="报告输出路径")
+    parser.add_argument("--commands", nargs="+", choices=COMMANDS, default=COMMANDS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[256, 1024], help="合成图片边长")
+    parser.add_argument("--final2x-sizes", nargs="+", type=int, default=[128, 256],
+                        help="final2x 使用的图片边长，CPU 上超分较慢")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--repeat", type=int, default=3, help="冷启动之后的重复次数")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--compare", help="基线报告路径")
+    parser.add_argument("--threshold", type=float, default=0.1, help="允许的吞吐下降比例")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)  # 子进程: 运行单个命令
+    parser.add_argument("--images", nargs="*", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        with open(args.result, "w", encoding="utf-8") as f:
+            json.dump(run_command(args.worker, args.images, args.repeat, args.workers), f)
+        return 0
+
+    report: Dict[str, Any] = {"environment": environment(), "config": vars(args), "results": {}}
+    image_dir = tempfile.mkdtemp(prefix="xingtu-bench-img-")
+    try:
+        for command in args.commands:
+            sizes = args.final2x_sizes if command == "final2x" else args.sizes
+            images = make_images(image_dir, sizes, args.modes)
+            print(f"运行 {command}: {len(images)} 张图片 x {args.repeat} 次")
+            result_file = os.path.join(image_dir, f"{command}.json")
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", command, "--repeat", str(args.repeat),
+                 "--workers", str(args.workers), "--result", result_file, "--images", *images],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+            if proc.returncode != 0:
+                lines = proc.stderr.strip().splitlines()
+                report["results"][command] = {"error": lines[-1] if lines else "benchmark failed"}
+            else:
+                with open(result_file, "r", encoding="utf-8") as f:
+                    report["results"][command] = json.load(f)
+            print(f"  {json.dumps(report['results'][command], ensure_ascii=False)}")
+            for image in images:
+                os.remove(image)
+    finally:
+        shutil.rmtree(image_dir, ignore_errors=True)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"报告已保存至: {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        return 0 if compare(report, baseline, args.threshold) else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+
+class ResultCache:
+    """
+    基于内容寻址的处理结果缓存
+
+    键为输入文件内容与相关配置的哈希值，缓存文件保存在 cache_dir 下，
+    总大小超过 max_mb 时按最近使用时间淘汰。多个进程可以同时使用同一个缓存目录。
+    """
+
+    def __init__(self, cache_dir: Union[str, Path], max_mb: int = 1024):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(command: str, params: Dict[str, Any], input_path: Optional[Union[str, Path]] = None,
+                 data: Optional[bytes] = None) -> str:
+        """
+        计算缓存键
+
+        Args:
+            command: 命令名
+            params: 影响输出结果的配置项
+            input_path: 输入文件路径，与 data 二选一
+            data: 输入文件内容
+
+        Returns:
+            十六进制的 sha256 字符串
+        """
+        h = hashlib.sha256()
+        h.update(json.dumps({"command": command, **params}, sort_keys=True, default=str).encode("utf-8"))
+        if data is not None:
+            h.update(data)
+        else:
+            with open(input_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+        return h.hexdigest()
+
+    def _entry(self, key: str) -> Optional[Path]:
+        for path in self.cache_dir.glob(key + ".*"):
+            if not path.name.endswith(".tmp"):
+                return path
+        return None
+
+    def get(self, key: str, dest_path: Union[str, Path]) -> bool:
+        """
+        缓存命中时将缓存的结果复制到 dest_path
+
+        Returns:
+            是否命中
+        """
+        entry = self._entry(key)
+        if entry is None:
+            return False
+        try:
+            shutil.copyfile(entry, dest_path)
+            os.utime(entry)  # 更新最近使用时间
+        except FileNotFoundError:  # 刚好被其他进程淘汰
+            return False
+        return True
+
+    def read(self, key: str) -> Optional[bytes]:
+        """读取缓存内容，未命中时返回 None"""
+        entry = self._entry(key)
+        if entry is None:
+            return None
+        try:
+            data = entry.read_bytes()
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def write(self, key: str, data: bytes, suffix: str = "") -> None:
+        """将内存中的数据加入缓存"""
+        tmp_path = self.cache_dir / f"{key}{suffix}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, self.cache_dir / f"{key}{suffix}")
+        except OSError as e:
+            print(f"写入缓存失败: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return
+        self.evict()
+
+    def put(self, key: str, src_path: Union[str, Path]) -> None:
+        """将处理结果加入缓存，并在超出大小上限时淘汰最久未使用的条目"""
+        suffix = Path(src_path).suffix
+        tmp_path = self.cache_dir / f"{key}{suffix}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            shutil.copyfile(src_path, tmp_path)
+            os.replace(tmp_path, self.cache_dir / f"{key}{suffix}")
+        except OSError as e:
+            print(f"写入缓存失败: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for path in self.cache_dir.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.is_file() and not path.name.endswith(".tmp"):
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+
+def open_cache(config) -> Optional[ResultCache]:
+    """根据 BaseConfig 中的 cache_dir 创建缓存，未配置时返回 None"""
+    if config.cache_dir is None:
+        return None
+    return ResultCache(config.cache_dir, config.cache_max_mb)
@@ -1,7 +1,18 @@
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Optional, Tuple, Union
+import io
 import os
 import uuid
 from config import XTConfig
+from batch import BatchReport, run_batch
+from cache import ResultCache, open_cache
+from incremental import open_incremental
+from planner import open_planner
+from events import stage
+from profiler import span
+from resize import decode_reduced
+from animation import is_animated, read_animation, save_animation, supports_animation
 
 
 def generate_unique_hash():
@@ -9,33 +20,186 @@ def generate_unique_hash():
     return uuid.uuid4().hex[:8]  # 使用8位哈希值，可以根据需要调整长度
 
 
-def compress_image(input_path, output_path, output_format='JPEG', quality=85):
+# 配置中的格式名到 Pillow 格式名的映射
+_PIL_FORMATS = {'JPG': 'JPEG', 'JPEG': 'JPEG', 'PNG': 'PNG', 'WEBP': 'WEBP'}
+
+# PNG 目标大小模式下依次尝试的调色板颜色数
+_PNG_PALETTE_COLORS = (256, 128, 64, 32, 16, 8)
+
+
+def prepare_image(img: Image.Image, pil_format: str) -> Image.Image:
+    """按输出格式处理透明通道和调色板图像"""
+    if img.mode in ('RGBA', 'P', 'LA'):
+        if pil_format == 'JPEG':
+            img = img.convert('RGB')  # JPEG不支持透明通道
+        elif pil_format in ('PNG', 'WEBP'):
+            img = img.convert('RGBA')  # PNG、WebP支持透明通道
+    elif img.mode not in ('RGB', 'L') and pil_format == 'JPEG':
+        img = img.convert('RGB')
+    return img
+
+
+def encode_image(img: Image.Image, pil_format: str, **options) -> bytes:
+    """在内存中编码图片"""
+    buffer = io.BytesIO()
+    with span("encode_image", format=pil_format, **options):
+        img.save(buffer, format=pil_format, optimize=True, **options)
+    return buffer.getvalue()
+
+
+def _quantizable(img: Image.Image) -> Image.Image:
+    """
+    转换为可以调色板量化的模式(L、RGB、RGBA)
+
+    16 位灰度(I;16、I)按比例缩放到 8 位，直接转换为 L 会把超过 255 的值截断为白色。
+    """
+    if img.mode in ('L', 'RGB', 'RGBA'):
+        return img
+    if img.mode.startswith('I'):
+        return img.convert('I').point(lambda v: v / 257).convert('L')
+    return img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+
+
+def _encode_png_candidate(img: Image.Image, colors: Optional[int]) -> bytes:
+    if colors is None:
+        return encode_image(img, 'PNG', compress_level=9)
+    img = _quantizable(img)
+    method = Image.Quantize.FASTOCTREE if img.mode == 'RGBA' else Image.Quantize.MEDIANCUT
+    return encode_image(img.quantize(colors=colors, method=method), 'PNG', compress_level=9)
+
+
+def search_target_size(img: Image.Image, pil_format: str, target_bytes: int,
+                       max_quality: int = 100) -> Tuple[bytes, str]:
+    """
+    并发地在内存中试编码，找出不超过目标大小的最佳编码结果
+
+    JPEG/WebP 搜索质量参数: 先在 [1, max_quality] 中均匀取若干个质量并发编码，
+    再在跨越目标大小的区间内逐个质量并发编码。PNG 依次尝试无损压缩和不同颜色数的调色板量化。
+    均无法满足目标大小时返回体积最小的结果。
+
+    :return: (编码结果, 所选参数的描述)
+    """
+    workers = min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if pil_format == 'PNG':
+            candidates = (None,) + _PNG_PALETTE_COLORS
+            results = list(executor.map(lambda c: _encode_png_candidate(img, c), candidates))
+            for colors, data in zip(candidates, results):
+                if len(data) <= target_bytes:
+                    return data, '无损' if colors is None else f'{colors} 色调色板'
+            colors, data = min(zip(candidates, results), key=lambda r: len(r[1]))
+            return data, '无损' if colors is None else f'{colors} 色调色板'
+
+        def encode(q: int) -> Tuple[int, bytes]:
+            return q, encode_image(img, pil_format, quality=q)
+
+        step = max(1, max_quality // workers)
+        qualities = sorted(set(range(max_quality, 0, -step)) | {1})
+        sizes = dict(executor.map(encode, qualities))
+        fitting = [q for q in qualities if len(sizes[q]) <= target_bytes]
+        low = max(fitting) if fitting else 1
+        higher = [q for q in qualities if q > low]
+        if fitting and higher:
+            # 在 (low, 下一个候选) 区间内细化
+            sizes.update(executor.map(encode, range(low + 1, min(higher))))
+            low = max(q for q, data in sizes.items() if len(data) <= target_bytes)
+        return sizes[low], f'质量 {low}'
+
+
+def save_compressed(img: Image.Image, output_file: Union[str, BinaryIO], output_format: str = 'JPEG', quality: int = 85,
+                    target_size_kb: Optional[float] = None) -> None:
+    """
+    按压缩参数保存图片
+    :param img: 输入图片
+    :param output_file: 输出文件路径或可写的二进制缓冲
+    :param output_format: 输出图片格式（如 'JPEG', 'PNG', 'WEBP'）
+    :param quality: 压缩质量(1-100)；目标大小模式下为质量上限
+    :param target_size_kb: 目标文件大小(KB)，设置后自动搜索不超过该大小的最佳压缩参数
+    """
+    pil_format = _PIL_FORMATS.get(output_format.upper(), output_format.upper())
+    # 处理透明通道和调色板图像
+    img = prepare_image(img, pil_format)
+
+    if target_size_kb is None:
+        img.save(output_file, format=pil_format, quality=quality, optimize=True)
+        return
+
+    img.load()
+    data, chosen = search_target_size(img, pil_format, int(target_size_kb * 1024), quality)
+    if len(data) > target_size_kb * 1024:
+        print(f"无法压缩到 {target_size_kb} KB 以内, 使用最小结果({chosen})")
+    else:
+        print(f"目标大小 {target_size_kb} KB, 使用{chosen}")
+    if hasattr(output_file, 'write'):
+        output_file.write(data)
+        return
+    with open(output_file, 'wb') as f:
+        f.write(data)
+
+
+def save_compressed_animation(img: Image.Image, output_file: str, output_format: str = 'WEBP', quality: int = 85,
+                              max_size: Optional[int] = None) -> None:
+    """
+    逐帧压缩动画，保留每帧时长与循环次数
+    :param img: 打开的动画图片
+    :param output_file: 输出文件路径
+    :param output_format: 'WEBP' 按 quality 有损编码，'PNG' 输出为 APNG
+    :param quality: 压缩质量(1-100)
+    :param max_size: 帧的最长边上限(像素)
+    """
+    pil_format = _PIL_FORMATS.get(output_format.upper(), output_format.upper())
+    loop = img.info.get('loop')
+    frames, durations = read_animation(img, lambda frame: prepare_image(frame, pil_format), max_size)
+    with stage("encode", format=output_format.lower(), frames=len(frames)) as record:
+        save_animation(frames, durations, output_file, output_format, loop, quality,
+                       **({'optimize': True} if pil_format == 'PNG' else {}))
+        record["bytes_out"] = os.path.getsize(output_file)
+
+
+def compress_image(input_path, output_path, output_format='JPEG', quality=85, cache: ResultCache = None,
+                   target_size_kb: Optional[float] = None, max_size: Optional[int] = None):
     """
     压缩图片质量
     :param input_path: 输入图片路径
     :param output_path: 输出图片路径
     :param output_format: 输出图片格式（如 'JPEG', 'PNG', 'WEBP'）
-    :param quality: 压缩质量(1-100)，数值越小压缩率越高
-    :return: 是否压缩成功
+    :param quality: 压缩质量(1-100)，数值越小压缩率越高；目标大小模式下为质量上限
+    :param cache: 结果缓存，命中时直接复制缓存的结果
+    :param target_size_kb: 目标文件大小(KB)，设置后自动搜索不超过该大小的最佳压缩参数
+    :param max_size: 输出图片最长边上限(像素)，JPEG 输入在解码时直接缩小
+    :return: 成功返回输出文件路径，失败返回None
     """
     try:
+        # 使用uuid生成唯一文件名
+        input_filename, input_ext = os.path.splitext(os.path.basename(input_path))
+        output_filename = f"{input_filename}_{generate_unique_hash()}.{output_format.lower()}"
+        output_path = os.path.join(output_path, output_filename)
+
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.make_key("compress", {"format": output_format.lower(), "quality": quality,
+                                                    "target_size_kb": target_size_kb, "max_size": max_size},
+                                       input_path=input_path)
+            if cache.get(cache_key, output_path):
+                print(f"命中缓存, 文件保存至: {output_path}")
+                return output_path
+
         with Image.open(input_path) as img:
-            # 处理透明通道和调色板图像
-            if img.mode in ('RGBA', 'P'):
-                if output_format.upper() == 'JPEG':
-                    img = img.convert('RGB')  # JPEG不支持透明通道
-                elif output_format.upper() == 'PNG':
-                    img = img.convert('RGBA')  # 保持透明通道
-                elif output_format.upper() == 'WEBP':
-                    img = img.convert('RGBA')  # WebP支持透明通道
-
-            # 保存图片
-            # 使用uuid生成唯一文件名
-            input_filename, input_ext = os.path.splitext(os.path.basename(input_path))
-            output_filename = f"{input_filename}_{generate_unique_hash()}.{output_format.lower()}"
-            output_path = os.path.join(output_path, output_filename)
-            print(f"文件保存至: {output_path}")
-            img.save(output_path, format=output_format, quality=quality, optimize=True)
+            if is_animated(img) and supports_animation(output_format):
+                print(f"文件保存至: {output_path}")
+                if target_size_kb is not None:
+                    print(f"动画图片不支持目标大小, 使用质量 {quality}")
+                save_compressed_animation(img, output_path, output_format, quality, max_size)
+            else:
+                with stage("decode", bytes_in=os.path.getsize(input_path)):
+                    img = decode_reduced(img, max_size)
+                # 保存图片
+                print(f"文件保存至: {output_path}")
+                with stage("encode", format=output_format.lower()) as record:
+                    save_compressed(img, output_path, output_format, quality, target_size_kb)
+                    record["bytes_out"] = os.path.getsize(output_path)
+            if cache_key is not None:
+                cache.put(cache_key, output_path)
 
             # 获取压缩前后文件大小
             original_size = os.path.getsize(input_path)
@@ -43,15 +207,21 @@ def compress_image(input_path, output_path, output_format='JPEG', quality=85):
             print(f"压缩完成: 原始大小 {original_size / 1024:.2f} KB, 压缩后 {compressed_size / 1024:.2f} KB")
             print(f"压缩比例: {(1 - compressed_size / original_size) * 100:.2f}%")
 
-            return True
+            return output_path
     except Exception as e:
         print(f"压缩失败: {e}")
-        return False
+        return None
 
 
-def compress_process(config: XTConfig):
-    output_path = config.compressConfig.output_path.joinpath("compress")
+def compress_process(config: XTConfig) -> BatchReport:
+    compress_config = config.compressConfig
+    output_path = compress_config.output_path.joinpath(compress_config.OUTPUT_DIR)
     if not output_path.exists():
         output_path.mkdir(parents=True, exist_ok=True)
-    compress_image(config.compressConfig.input_path[0], output_path, config.compressConfig.target_format,
-                   config.compressConfig.quality)
+    cache = open_cache(compress_config)
+    tasks = ((compress_image, str(p), (output_path, compress_config.target_format, compress_config.quality, cache,
+                                       compress_config.target_size_kb, compress_config.max_size))
+             for p in compress_config.iter_inputs())
+    return run_batch("compress", tasks, compress_config.workers, open_incremental("compress", compress_config),
+                     open_planner("compress", compress_config), compress_config.input_total())
+
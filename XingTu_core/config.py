@@ -1,43 +1,201 @@
-from pydantic import BaseModel, DirectoryPath, FilePath, Field
-from ccrestoration import ConfigType
+from pydantic import BaseModel, DirectoryPath, FilePath, Field, model_validator
 from pathlib import Path
-import yaml
 import json
 import base64
-from typing import List, Union, Optional, Literal
+from typing import Annotated, Any, ClassVar, Dict, Iterator, List, Union, Optional, Literal
 
 # 定义可能的枚举类型（根据 TypeScript 的 ImageFormat 和 XingTuCommand 调整）
 ImageFormat = Literal["jpg", "png", "webp"]  # 假设 ImageFormat 是这些值
-XingTuCommand = Literal["format", "compress", "remove_bg", "final2x"]  # 假设 Command 是这些值
+XingTuCommand = Literal["format", "compress", "remove_bg", "final2x", "pipeline", "stream"]  # 假设 Command 是这些值
 
 class BaseConfig(BaseModel):
-    input_path: List[FilePath]
+    OUTPUT_DIR: ClassVar[str] = ""  # 命令在 output_path 下的输出子目录
+    input_path: List[FilePath] = []
     output_path: DirectoryPath
+    manifest: Optional[str] = None  # JSON-lines 输入清单路径，"-" 为标准输入；边读取边处理，路径不预先校验
+    input_dirs: List[DirectoryPath] = []  # 输入目录，按 patterns 匹配其中的文件
+    input_globs: List[str] = []  # glob 模式，支持 ** 匹配多级目录
+    patterns: List[str] = ["*.png", "*.jpg", "*.jpeg", "*.webp", "*.bmp", "*.tif", "*.tiff", "*.gif",
+                           "*.heic", "*.avif"]  # input_dirs 中文件名的匹配模式(不区分大小写)
+    recursive: bool = False  # 是否递归遍历 input_dirs 的子目录
+    incremental: bool = False  # 增量模式: 跳过上次运行后未改变的输入文件
     task_id: Optional[str] = None
+    workers: int = Field(default=1, ge=1)  # 批处理进程数，1 表示在当前进程中顺序处理
+    cache_dir: Optional[Path] = None  # 结果缓存目录，相同输入与配置的任务直接复用上次的结果
+    cache_max_mb: int = Field(default=1024, ge=1)  # 结果缓存总大小上限(MB)
+    # 内存预算(MB): 按文件头估算各任务的内存，同时处理的任务预计内存之和不超过该值，大图单独处理
+    memory_budget_mb: Optional[int] = Field(default=None, ge=1)
+    model_dir: Optional[Path] = None  # 本地模型仓库目录，见 model_store.py
+    offline: bool = False  # 离线模式: 只使用模型仓库中的模型，不访问网络
 
+    def input_total(self) -> Optional[int]:
+        """输入文件数，包含清单、目录或 glob 输入时(边遍历边处理)无法预先得知，返回 None"""
+        if self.manifest is not None or self.input_dirs or self.input_globs:
+            return None
+        return len(self.input_path)
 
-class FormatConfig(BaseConfig):
-    target_format: str
+    def iter_inputs(self) -> Iterator[Path]:
+        """依次产出 input_path、目录与 glob 匹配到的文件以及清单中的输入文件"""
+        yield from self.input_path
+        if self.input_dirs or self.input_globs:
+            from manifest import iter_directory_inputs
+            yield from iter_directory_inputs(self)
+        if self.manifest is not None:
+            from manifest import iter_manifest
+            yield from iter_manifest(self.manifest)
 
 
-class CompressConfig(BaseConfig):
+# 各命令的处理参数与输入输出路径分开定义，流水线的各个阶段复用这些参数
+
+class FormatTarget(BaseModel):
+    format: str
+    quality: Optional[int] = Field(default=None, ge=1, le=100)  # 为空时使用该格式的默认质量
+    options: Dict[str, Any] = {}  # 透传给 Pillow save 的其他编码参数
+
+
+class FormatOptions(BaseModel):
+    target_format: Optional[str] = None
+    targets: List[FormatTarget] = []  # 一次解码输出多个格式，设置后忽略 target_format
+    max_size: Optional[int] = Field(default=None, ge=1)  # 输出图片最长边上限(像素)，超过时等比缩小
+
+    def get_targets(self) -> List[FormatTarget]:
+        if self.targets:
+            return self.targets
+        return [FormatTarget(format=self.target_format or "png")]
+
+
+class FormatConfig(BaseConfig, FormatOptions):
+    OUTPUT_DIR: ClassVar[str] = "format"
+
+
+class CompressOptions(BaseModel):
     target_format: ImageFormat
-    quality: int = Field(ge=1, le=100)  # 限制 quality 在 1-100 之间
+    quality: int = Field(default=85, ge=1, le=100)  # 限制 quality 在 1-100 之间
+    target_size_kb: Optional[float] = Field(default=None, gt=0)  # 目标文件大小(KB)，设置后 quality 作为质量上限
+    max_size: Optional[int] = Field(default=None, ge=1)  # 输出图片最长边上限(像素)，超过时等比缩小
+
+
+class CompressConfig(BaseConfig, CompressOptions):
+    OUTPUT_DIR: ClassVar[str] = "compress"
+
 
+class RembgSessionConfig(BaseModel):
+    """rembg 会话缓存及 onnxruntime 会话参数"""
+    cache_size: int = Field(default=2, ge=1)  # 最多同时缓存的会话数，超出时淘汰最久未使用的会话
+    cache_memory_mb: Optional[int] = Field(default=None, ge=1)  # 缓存会话的模型总大小上限(MB)
+    intra_op_num_threads: Optional[int] = Field(default=None, ge=0)
+    inter_op_num_threads: Optional[int] = Field(default=None, ge=0)
+    graph_optimization_level: Literal["disable", "basic", "extended", "all"] = "all"
+    execution_mode: Literal["sequential", "parallel"] = "sequential"
+    warmup: bool = False  # 创建会话后先用空白图片推理一次
 
-class RemoveBgConfig(BaseConfig):
-    bg_color: str
+
+class RemoveBgOptions(BaseModel):
+    bg_color: Optional[str] = None
+    bg_colors: List[Optional[str]] = []  # 同一张蒙版合成多种背景色，每种颜色输出一张图片，空值为透明背景
     model: str
-    
-    
-class Final2xConfig(BaseConfig):
-    input_path: List[FilePath]
-    output_path: DirectoryPath
-    pretrained_model_name: Union[ConfigType, str]
+    session: RembgSessionConfig = Field(default_factory=RembgSessionConfig)
+    mask_only: bool = False  # 只输出蒙版
+    save_mask: bool = False  # 额外输出蒙版
+
+    def get_bg_colors(self) -> List[Optional[str]]:
+        return self.bg_colors or [self.bg_color]
+
+
+class RemoveBgConfig(BaseConfig, RemoveBgOptions):
+    OUTPUT_DIR: ClassVar[str] = "koutu"
+
+
+class Final2xOptions(BaseModel):
+    pretrained_model_name: str  # ccrestoration 的 ConfigType 取值，此处不导入 ccrestoration 以减少启动耗时
     device: str
     gh_proxy: Optional[str] = None
     target_scale: Optional[Union[int, float]] = None
-    cc_model_scale: Optional[int] = None    
+    cc_model_scale: Optional[int] = None
+    tile_size: Optional[Union[int, Literal["auto"]]] = None  # 分块推理的块大小，None 时由 ccrestoration 按 128x128 分块，"auto" 根据可用内存/显存自动选择
+    tile_overlap: int = Field(default=32, ge=0)  # 相邻分块的重叠像素，重叠区域线性融合以消除接缝
+    prefetch: int = Field(default=2, ge=1)  # 预先解码等待推理的图片数
+    encode_workers: int = Field(default=2, ge=1)  # PNG 编码及写入的线程数
+    # 透明通道处理方式: sr 为透明通道单独超分(质量最好)，batch 为 RGB 与透明通道合并为一次批量推理，
+    # interpolate 为透明通道使用双三次插值放大(最快)
+    alpha_mode: Literal["sr", "batch", "interpolate"] = "sr"
+    batch_size: int = Field(default=1, ge=1)  # 同尺寸图片合并为一次批量推理的最大数量
+    batch_pad: Optional[int] = Field(default=None, ge=1)  # 尺寸向上取整到该值的倍数后分组，不同尺寸的图片填充后合并推理
+    fp16: Union[bool, Literal["auto"]] = False  # 半精度推理，"auto" 在支持的 CUDA 设备上自动启用
+    fp16_check: bool = False  # 加载后将 fp16 输出与 fp32 对比，误差过大时回退到 fp32
+    torch_threads: Optional[int] = Field(default=None, ge=1)  # torch CPU 推理线程数
+    channels_last: bool = False  # 模型及输入使用 channels_last 内存布局
+    compile: bool = False  # 使用 torch.compile 编译模型
+    cudnn_benchmark: bool = False  # 启用 cudnn.benchmark，输入尺寸固定时可加速卷积
+
+
+class Final2xConfig(BaseConfig, Final2xOptions):
+    OUTPUT_DIR: ClassVar[str] = "outputs"
+    input_path: List[FilePath] = []
+    output_path: DirectoryPath
+    # 分片模式: 每个设备一个工作进程，各自加载模型并从共享队列中取图片处理，例如 ["cuda:0", "cuda:1"]
+    # 或 ["cpu", "cpu", "cpu", "cpu"]；至少两个设备时启用，CPU 线程数在各进程间平分(或使用 torch_threads)
+    devices: List[str] = []
+
+
+class FormatStage(FormatOptions):
+    command: Literal["format"]
+
+
+class CompressStage(CompressOptions):
+    command: Literal["compress"]
+
+
+class RemoveBgStage(RemoveBgOptions):
+    command: Literal["remove_bg"]
+
+
+class Final2xStage(Final2xOptions):
+    command: Literal["final2x"]
+
+
+PipelineStage = Annotated[
+    Union[FormatStage, CompressStage, RemoveBgStage, Final2xStage], Field(discriminator="command")
+]
+
+
+def check_stages(stages: List[PipelineStage]) -> None:
+    # format、compress 决定输出文件的编码，只能作为最后一个阶段
+    for stage in stages[:-1]:
+        if stage.command in ("format", "compress"):
+            raise ValueError(f"{stage.command} stage must be the last stage of a pipeline")
+    for stage in stages:
+        if stage.command == "remove_bg" and len(stage.get_bg_colors()) > 1:
+            raise ValueError("remove_bg stage of a pipeline accepts a single bg_color")
+
+
+class PipelineConfig(BaseConfig):
+    """按顺序执行多个阶段，阶段之间在内存中传递图片，只写出最终结果"""
+    OUTPUT_DIR: ClassVar[str] = "pipeline"
+    stages: List[PipelineStage] = Field(min_length=1)
+
+    @model_validator(mode="after")
+    def check_encode_stage(self) -> "PipelineConfig":
+        check_stages(self.stages)
+        return self
+
+
+class StreamConfig(BaseModel):
+    """
+    流模式: 从标准输入读取图片字节，按 stages 处理后把结果写到标准输出，不读写文件
+
+    framed 为 False 时标准输入是一张完整的图片；为 True 时是多帧，每帧为 4 字节大端长度加图片数据，
+    每张图片的每个输出同样按帧写出，处理失败的图片输出长度为 0 的帧。
+    """
+    stages: List[PipelineStage] = Field(min_length=1)
+    framed: bool = False
+    model_dir: Optional[Path] = None
+    offline: bool = False
+
+    @model_validator(mode="after")
+    def check_stages(self) -> "StreamConfig":
+        check_stages(self.stages)
+        return self
 
 
 class XTConfig(BaseModel):
@@ -46,10 +204,35 @@ class XTConfig(BaseModel):
     compressConfig: Optional[CompressConfig] = None
     removeBgConfig: Optional[RemoveBgConfig] = None
     final2xConfig: Optional[Final2xConfig] = None
+    pipelineConfig: Optional[PipelineConfig] = None
+    streamConfig: Optional[StreamConfig] = None
+
+    # 各命令对应的配置字段
+    CONFIG_FIELDS: ClassVar[Dict[str, str]] = {
+        "format": "formatConfig",
+        "compress": "compressConfig",
+        "remove_bg": "removeBgConfig",
+        "final2x": "final2xConfig",
+        "pipeline": "pipelineConfig",
+        "stream": "streamConfig",
+    }
+
+    def get_command_config(self) -> Optional[Union[BaseConfig, StreamConfig]]:
+        """当前命令对应的配置"""
+        return getattr(self, self.CONFIG_FIELDS[self.command])
+
+    def require_command_config(self) -> Union[BaseConfig, StreamConfig]:
+        """当前命令对应的配置，缺少时抛出 ValueError"""
+        command_config = self.get_command_config()
+        if command_config is None:
+            raise ValueError(f"missing {self.CONFIG_FIELDS[self.command]} for command {self.command}")
+        return command_config
 
     @classmethod
     def from_yaml(cls, yaml_path: Union[Path, str]) -> "XTConfig":
         """从 YAML 文件加载配置"""
+        import yaml
+
         with open(yaml_path, "r", encoding="utf-8") as f:
             try:
                 config = yaml.safe_load(f)
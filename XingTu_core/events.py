@@ -0,0 +1,189 @@
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, IO, Iterator, List, Optional
+import json
+import os
+import sys
+import threading
+import time
+
+import profiler
+
+# 结构化进度事件: 每个文件、每个阶段(decode/inference/encode/write)输出一行 JSON，
+# 包含耗时、输入输出字节数及内存峰值，供前端统计慢阶段和估算剩余时间。
+#
+# 批处理子进程不直接写事件，而是把阶段记录随 FileResult 返回，由主进程统一输出，
+# 因此事件文件只有一个写入者。子进程通过环境变量得知是否需要记录阶段。
+EVENTS_ENV = "XINGTU_EVENTS"
+
+_sink: Optional[IO[str]] = None
+_lock = threading.Lock()
+_stages: Optional[List[Dict[str, Any]]] = None
+
+
+def configure(path: Optional[str]) -> None:
+    """
+    打开事件输出
+
+    :param path: 事件文件路径，"-" 表示标准错误；可以是命名管道或 /dev/fd/N
+    """
+    global _sink
+    if path is None:
+        return
+    _sink = sys.stderr if path == "-" else open(path, "a", encoding="utf-8", buffering=1)
+    os.environ[EVENTS_ENV] = "1"
+
+
+class _Forward:
+    """把事件行交给回调，由回调转发给主进程"""
+
+    def __init__(self, write: Callable[[str], None]):
+        self.write = write
+
+
+def forward(write: Callable[[str], None]) -> None:
+    """
+    在不经过 batch 收集阶段记录的子进程中调用(如 final2x 分片进程): 每行事件交给 write 转发，
+    由主进程调用 write_line 统一写出
+    """
+    global _sink
+    _sink = _Forward(write)  # type: ignore[assignment]
+
+
+def write_line(line: str) -> None:
+    """写出子进程转发的一行事件(已包含换行符)"""
+    if _sink is None:
+        return
+    with _lock:
+        _sink.write(line)
+
+
+def enabled() -> bool:
+    return _sink is not None or os.environ.get(EVENTS_ENV) == "1"
+
+
+def peak_rss_mb() -> Optional[float]:
+    """当前进程的内存峰值(MB)"""
+    # Linux 下优先读取 VmHWM: ru_maxrss 会继承 exec 之前父进程的峰值
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 下单位为 KB，macOS 下为字节
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    except ImportError:
+        pass
+    try:
+        import psutil
+
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / (1024 * 1024), 1)
+    except Exception:
+        return None
+
+
+def emit(event: str, **fields: Any) -> None:
+    """输出一条事件，未开启事件输出时不做任何事"""
+    if _sink is None:
+        return
+    line = json.dumps({"event": event, "ts": time.time(), "pid": os.getpid(), **fields},
+                      ensure_ascii=False, default=str)
+    with _lock:
+        _sink.write(line + "\n")
+
+
+@contextmanager
+def stage(name: str, **fields: Any) -> Iterator[Dict[str, Any]]:
+    """
+    记录一个处理阶段的耗时
+
+    用法:
+        with stage("encode", file=path) as record:
+            ...
+            record["bytes_out"] = len(data)
+
+    在 collect_stages 中执行时阶段记录会被收集起来随文件结果返回，否则直接输出 stage 事件。
+    开启性能分析时同时记录为 trace 区间。
+    """
+    profiling = profiler.enabled()
+    if not profiling and not enabled():
+        yield {}
+        return
+    record: Dict[str, Any] = {"stage": name, **fields}
+    ts = profiler.now_us()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        duration = time.perf_counter() - start
+        if profiling:
+            profiler.record(name, ts, duration, {k: v for k, v in record.items() if k != "stage"})
+        if enabled():
+            record["duration"] = duration
+            record["peak_rss_mb"] = peak_rss_mb()
+            with _lock:
+                collected = _stages
+                if collected is not None:
+                    collected.append(record)
+            if collected is None:
+                emit("stage", **record)
+
+
+@contextmanager
+def collect_stages() -> Iterator[List[Dict[str, Any]]]:
+    """收集处理单个文件期间各阶段的记录"""
+    global _stages
+    records: List[Dict[str, Any]] = []
+    previous, _stages = _stages, records
+    try:
+        yield records
+    finally:
+        _stages = previous
+
+
+def _file_size(path: Optional[str]) -> Optional[int]:
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+def output_size(output: Any) -> Optional[int]:
+    """输出文件或内存缓冲(BytesIO)的字节数"""
+    if hasattr(output, "getbuffer"):
+        return output.getbuffer().nbytes
+    return _file_size(output)
+
+
+def emit_file(command: str, result: Any, done: int, elapsed: float) -> None:
+    """
+    输出单个文件的处理结果
+
+    :param result: batch.FileResult
+    :param done: 本次批处理已完成的文件数
+    :param elapsed: 本次批处理已耗时(秒)
+    """
+    if _sink is None:
+        return
+    output_sizes = [_file_size(p) for p in result.output_paths]
+    emit(
+        "file",
+        command=command,
+        input_path=result.input_path,
+        output_paths=result.output_paths,
+        success=result.success,
+        skipped=result.skipped,
+        error=result.error,
+        duration=result.elapsed,
+        bytes_in=_file_size(result.input_path),
+        bytes_out=sum(s for s in output_sizes if s is not None),
+        stages=result.stages,
+        done=done,
+        batch_elapsed=elapsed,
+    )
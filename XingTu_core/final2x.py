@@ -1,14 +1,46 @@
 from config import XTConfig
+from batch import BatchReport, FileResult
+from cache import ResultCache, open_cache
+from incremental import IncrementalManifest, open_incremental
+import events
+import model_store
+import profiler
+from planner import (CC_TILE_PAD, CC_TILE_SIZE, FEATURE_BYTES_PER_PIXEL, OUTPUT_BYTES_PER_PIXEL, MemoryBudget,
+                     final2x_bytes, read_header)
 from loguru import logger
 from pathlib import Path
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextlib
+import copy
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
 import torch
 import cv2
 import numpy as np
 import math
-from typing import Any, List, Optional, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 from ccrestoration import AutoModel, SRBaseModel
 from ccrestoration import AutoConfig, BaseConfig, ConfigType
 from ccrestoration.util.device import default_device
+from ccrestoration.model import sr_base_model
+from PIL import Image
+
+# 已加载的超分模型，按 (模型名, 设备, fp16) 缓存，常驻服务模式下跨任务复用
+_sr_models = {}
+
+# Minimum PSNR of the fp16 output against fp32 for fp16 to be kept after the self-check
+_FP16_MIN_PSNR = 40.0
+
+# Tasks waiting in the sharded queue per worker
+_SHARD_QUEUE_PER_WORKER = 2
+
+# Tile sizes tried by the automatic tile selection, largest first
+_AUTO_TILE_SIZES = (1024, 768, 512, 384, 256, 192, 128)
 
 def get_device(device: str) -> Union[torch.device, str]:
     """
@@ -21,7 +53,7 @@ def get_device(device: str) -> Union[torch.device, str]:
     elif device.startswith("cpu"):
         return torch.device("cpu")
     elif device.startswith("cuda"):
-        return torch.device("cuda")
+        return torch.device(device)  # "cuda" or "cuda:<index>"
     elif device.startswith("mps"):
         return torch.device("mps")
     elif device.startswith("directml"):
@@ -65,19 +97,32 @@ class PrintProgressLog:
         self.Total = 0
         self.progressCurrent = 0
         self.sr_n = 1
+        # In a sharded worker process, progress is forwarded to the main process instead of logged
+        self.forward: Optional[Callable[..., None]] = None
 
     @logger.catch(reraise=True)  # type: ignore
-    def set(self, total_file: int, sr_n: int) -> None:
-        if total_file <= 0:
+    def set(self, total_file: Optional[int], sr_n: int) -> None:
+        """
+        :param total_file: number of files, None when unknown (streamed from a manifest)
+        """
+        if total_file is not None and total_file <= 0:
             raise AssertionError("Total must be greater than 0")
         if sr_n < 1:
             raise AssertionError("sr_n must be greater than 1")
-        self.Total = total_file * sr_n
+        self.Total = 0 if total_file is None else total_file * sr_n
         self.sr_n = sr_n
+        self.progressCurrent = 0
 
     @logger.catch  # type: ignore
     def printProgress(self) -> None:
+        if self.forward is not None:
+            self.forward("progress")
+            return
         self.progressCurrent += 1
+        events.emit("progress", command="final2x", current=self.progressCurrent, total=self.Total or None)
+        if self.Total <= 0:
+            logger.info("Processing------[ " + str(self.progressCurrent) + " ]")
+            return
         percentage: float = round(self.progressCurrent / self.Total * 100, 1)
         logger.info("Processing------[ " + str(percentage) + "% ]")
 
@@ -86,27 +131,312 @@ class PrintProgressLog:
         for _ in range(self.sr_n):
             self.printProgress()
 
+    def addTotal(self, n: int) -> None:
+        """
+        Add n progress steps to a known total, e.g. for the extra pass over an alpha channel
+        """
+        if self.forward is not None:
+            self.forward("total", n)
+        elif self.Total > 0:
+            self.Total += n
+
+def resolve_fp16(fp16: Union[bool, str], device: Any) -> bool:
+    """
+    Resolve the fp16 option, "auto" enables fp16 on CUDA devices with tensor cores (compute capability >= 7.0)
+
+    :param fp16: True, False or "auto"
+    :param device: inference device
+    """
+    if fp16 != "auto":
+        return bool(fp16)
+    try:
+        return getattr(device, "type", None) == "cuda" and torch.cuda.get_device_capability(device)[0] >= 7
+    except Exception:
+        return False
+
+
+def fp16_self_check(sr_model: SRBaseModel) -> float:
+    """
+    Compare the fp16 model output with an fp32 copy on a synthetic image
+
+    :param sr_model: SR model loaded with fp16
+    :return: PSNR of the fp16 output against the fp32 output, in dB
+    """
+    rng = np.random.default_rng(0)
+    img = cv2.GaussianBlur((rng.random((64, 64, 3)) * 255).astype(np.uint8), (5, 5), 1.5)
+    with torch.inference_mode():
+        tensor = torch.from_numpy(img).permute(2, 0, 1).unsqueeze(0).to(sr_model.device).float().div_(255.0)
+        reference = copy.deepcopy(sr_model.model).float()(tensor).float().clamp_(0, 1)
+        output = sr_model.model(tensor.half()).float().clamp_(0, 1)
+        mse = torch.mean((reference - output) ** 2).item()
+    return float("inf") if mse == 0 else 10 * math.log10(1.0 / mse)
+
+
+def cc_tile(config: XTConfig) -> Optional[Tuple[int, int]]:
+    """
+    Tile size of ccrestoration's own tiled inference
+
+    When tile_size is set, tiled_inference already splits the image and every tile runs through
+    the model whole, otherwise ccrestoration tiles the image itself.
+    """
+    return None if config.tile_size is not None else (CC_TILE_SIZE, CC_TILE_SIZE)
+
+
+def _from_pretrained(config: XTConfig, device: Any, fp16: bool) -> SRBaseModel:
+    """
+    Create the SR model, taking the weights from the local model store when one is configured
+
+    Weights from the store are already verified against the index, ccrestoration then loads them
+    by path without hashing the file again or touching the network.
+    """
+    weights = model_store.sr_weights(str(config.pretrained_model_name), config.gh_proxy)
+    if weights is None:
+        return AutoModel.from_pretrained(
+            pretrained_model_name=config.pretrained_model_name,
+            fp16=fp16,
+            device=device,
+            tile=cc_tile(config),
+            tile_pad=CC_TILE_PAD,
+            gh_proxy=config.gh_proxy,
+        )
+    sr_config = AutoConfig.from_pretrained(config.pretrained_model_name).model_copy(update={"path": weights})
+    return AutoModel.from_config(config=sr_config, fp16=fp16, device=device, tile=cc_tile(config),
+                                 tile_pad=CC_TILE_PAD)
+
+
+def load_sr_model(config: XTConfig) -> SRBaseModel:
+    """
+    Load the SR model described by config, reusing an already loaded instance when possible
+
+    :param config: Final2xConfig
+    """
+    device = get_device(config.device)
+    fp16 = resolve_fp16(config.fp16, device)
+    if config.torch_threads is not None:
+        torch.set_num_threads(config.torch_threads)
+    if config.cudnn_benchmark:
+        torch.backends.cudnn.benchmark = True
+
+    key = (str(config.pretrained_model_name), config.device, fp16, config.channels_last, config.compile,
+           cc_tile(config))
+    if key in _sr_models:
+        return _sr_models[key]
+
+    if profiler.enabled() and not hasattr(sr_base_model.load_file_from_url, "__wrapped__"):
+        # weights are located, verified and downloaded inside from_pretrained, trace that step separately
+        sr_base_model.load_file_from_url = profiler.traced("load_file_from_url")(sr_base_model.load_file_from_url)
+
+    with profiler.span("AutoModel.from_pretrained", model=str(config.pretrained_model_name), fp16=fp16):
+        sr_model = _from_pretrained(config, device, fp16)
+
+    if sr_model.fp16 and config.fp16_check:
+        with profiler.span("fp16_self_check"):
+            psnr = fp16_self_check(sr_model)
+        logger.info(f"fp16 self-check PSNR against fp32: {psnr:.2f} dB")
+        if psnr < _FP16_MIN_PSNR:
+            logger.warning(f"fp16 output differs too much from fp32 (< {_FP16_MIN_PSNR} dB), fall back to fp32")
+            sr_model = _from_pretrained(config, device, False)
+
+    if config.channels_last:
+        sr_model.model = sr_model.model.to(memory_format=torch.channels_last)
+
+    if config.compile:
+        # same backend choice as ccrestoration, compiled here so that channels_last is applied first
+        backend = "aot_eager" if sys.platform == "darwin" else "inductor"
+        try:
+            with profiler.span("torch.compile", backend=backend):
+                sr_model.model = torch.compile(sr_model.model, backend=backend)
+        except Exception as e:
+            logger.warning("torch.compile is not supported on this model: " + str(e))
+
+    logger.info(f"SR model loaded, fp16: {sr_model.fp16}, channels_last: {config.channels_last}, "
+                f"compile: {config.compile}, torch threads: {torch.get_num_threads()}")
+    _sr_models[key] = sr_model
+    return sr_model
+
+
+def available_memory(device: Any) -> Optional[int]:
+    """
+    Free memory in bytes usable for inference on device, None if unknown
+
+    :param device: torch device the model runs on
+    """
+    try:
+        if getattr(device, "type", None) == "cuda":
+            free, _ = torch.cuda.mem_get_info(device)
+            return int(free)
+        import psutil
+
+        return int(psutil.virtual_memory().available)
+    except Exception as e:
+        logger.warning("Failed to query available memory: " + str(e))
+        return None
+
+
+def auto_tile_size(available: Optional[int], scale: float) -> int:
+    """
+    Pick the largest tile size whose estimated peak memory fits in half of the available memory
+
+    :param available: available memory in bytes, None if unknown
+    :param scale: model scale
+    """
+    if available is None:
+        return 512
+    budget = available * 0.5
+    for tile in _AUTO_TILE_SIZES:
+        pixels = tile * tile
+        if pixels * FEATURE_BYTES_PER_PIXEL + pixels * scale * scale * OUTPUT_BYTES_PER_PIXEL <= budget:
+            return tile
+    return _AUTO_TILE_SIZES[-1]
+
+
+def _tile_starts(length: int, tile: int, overlap: int) -> List[int]:
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, tile - overlap))
+    starts.append(length - tile)
+    return starts
+
+
+def _blend_weights(length: int, start_overlap: int, end_overlap: int) -> np.ndarray:
+    """1D linear ramp, so overlapping ramps of neighbouring tiles sum to 1"""
+    w = np.ones(length, dtype=np.float32)
+    if start_overlap > 0:
+        w[:start_overlap] = (np.arange(start_overlap, dtype=np.float32) + 0.5) / start_overlap
+    if end_overlap > 0:
+        ramp = (np.arange(end_overlap, dtype=np.float32)[::-1] + 0.5) / end_overlap
+        w[-end_overlap:] = np.minimum(w[-end_overlap:], ramp)
+    return w
+
+
+def _overlaps(starts: List[int], tile: int, i: int) -> Tuple[int, int]:
+    before = starts[i - 1] + tile - starts[i] if i > 0 else 0
+    after = starts[i] + tile - starts[i + 1] if i < len(starts) - 1 else 0
+    return before, after
+
+
+def tiled_inference(inference: Callable[[np.ndarray], np.ndarray], img: np.ndarray,
+                    tile: int, overlap: int) -> np.ndarray:
+    """
+    Run inference tile by tile and blend the overlapping borders, peak memory is bounded by the tile size
+
+    Tiles are processed one row at a time and blended in a float band as tall as one row of tiles.
+    Rows no later tile touches are written to the output in its final dtype, only the overlap
+    with the next row of tiles is carried over.
+
+    :param inference: function that upscales one image
+    :param img: image to process, HWC or HW
+    :param tile: tile size in input pixels
+    :param overlap: overlap between neighbouring tiles in input pixels
+    """
+    h, w = img.shape[:2]
+    overlap = max(0, min(overlap, tile // 2))
+    ys, xs = _tile_starts(h, tile, overlap), _tile_starts(w, tile, overlap)
+
+    out: Optional[np.ndarray] = None
+    band: np.ndarray = np.zeros(0, dtype=np.float32)  # blended output rows [band_start, band_start + len(band))
+    weight: np.ndarray = np.zeros(0, dtype=np.float32)
+    band_start = 0
+    scale: float = 1.0
+    for iy, y in enumerate(ys):
+        for ix, x in enumerate(xs):
+            patch = np.ascontiguousarray(img[y: y + tile, x: x + tile])
+            res = inference(patch)
+            if out is None:
+                scale = res.shape[0] / patch.shape[0]
+                out = np.empty((round(h * scale), round(w * scale)) + res.shape[2:], dtype=res.dtype)
+                band = np.zeros((0,) + out.shape[1:], dtype=np.float32)
+                weight = np.zeros((0, out.shape[1]), dtype=np.float32)
+            oy, ox = round(y * scale), round(x * scale)
+            th, tw = min(res.shape[0], out.shape[0] - oy), min(res.shape[1], out.shape[1] - ox)
+            if ix == 0 and oy + th > band_start + len(band):
+                # grow the band to cover this row of tiles, keeping the carried-over overlap
+                grown = np.zeros((oy + th - band_start,) + out.shape[1:], dtype=np.float32)
+                grown_weight = np.zeros((oy + th - band_start, out.shape[1]), dtype=np.float32)
+                grown[: len(band)], grown_weight[: len(band)] = band, weight
+                band, weight = grown, grown_weight
+
+            top, bottom = (round(o * scale) for o in _overlaps(ys, tile, iy))
+            left, right = (round(o * scale) for o in _overlaps(xs, tile, ix))
+            mask = np.outer(_blend_weights(res.shape[0], top, bottom), _blend_weights(res.shape[1], left, right))
+            res, mask = res[:th, :tw], mask[:th, :tw]
+
+            by = oy - band_start
+            weight[by: by + th, ox: ox + tw] += mask
+            if res.ndim == 3:
+                mask = mask[:, :, None]
+            band[by: by + th, ox: ox + tw] += res.astype(np.float32) * mask
+
+        # rows above the next row of tiles are final
+        done = round(ys[iy + 1] * scale) - band_start if iy + 1 < len(ys) else len(band)
+        _write_rows(out, band_start, band[:done], weight[:done])  # type: ignore
+        band, weight = band[done:], weight[done:]
+        band_start += done
+    return out  # type: ignore
+
+
+def _write_rows(out: np.ndarray, start: int, rows: np.ndarray, weight: np.ndarray) -> None:
+    """Normalize blended rows by their weights and store them in out from row start"""
+    rows /= np.maximum(weight, 1e-6)[:, :, None] if rows.ndim == 3 else np.maximum(weight, 1e-6)
+    if np.issubdtype(out.dtype, np.integer):
+        info = np.iinfo(out.dtype)
+        rows = np.clip(np.rint(rows), info.min, info.max)
+    out[start: start + len(rows)] = rows
+
+
 class CCRestoration:
     """
     Super-resolution class for processing images, using ccrestoration.
 
     :param config: XTConfig
+    :param total_file: number of images for progress logging, None when unknown
     """
 
-    def __init__(self, config: XTConfig) -> None:
+    def __init__(self, config: XTConfig, total_file: Optional[int] = None) -> None:
         self.config: XTConfig = config
 
-        PrintProgressLog().set(len(self.config.input_path), 1)
+        PrintProgressLog().set(total_file, 1)
 
-        self._SR_class: SRBaseModel = AutoModel.from_pretrained(
-            pretrained_model_name=self.config.pretrained_model_name,
-            fp16=False,
-            device=get_device(self.config.device),
-            gh_proxy=self.config.gh_proxy,
-        )
+        self._SR_class: SRBaseModel = load_sr_model(self.config)
 
         logger.info("SR Class init, device: " + str(self._SR_class.device))
 
+        self.tile_size: Optional[int] = None
+        if self.config.tile_size == "auto":
+            self.tile_size = auto_tile_size(available_memory(self._SR_class.device), self.config.cc_model_scale or 4)
+            logger.info("Auto tile size: " + str(self.tile_size))
+        elif self.config.tile_size is not None:
+            self.tile_size = max(int(self.config.tile_size), 2 * self.config.tile_overlap + 1)
+
+    def cache_params(self) -> Dict[str, Any]:
+        """
+        Parameters that change the output pixels, for the result cache key
+
+        fp16 and tile_size are the resolved values, so "auto" settings that resolve differently
+        on different hosts sharing a cache give different keys.
+        """
+        return {
+            "model": str(self.config.pretrained_model_name),
+            "target_scale": self.config.target_scale,
+            "alpha_mode": self.config.alpha_mode,
+            "fp16": self._SR_class.fp16,
+            "tile_size": self.tile_size,
+            "tile_overlap": self.config.tile_overlap if self.tile_size is not None else None,
+            "batch_pad": self.config.batch_pad,
+        }
+
+    def inference(self, img: np.ndarray) -> np.ndarray:
+        """
+        Run the model on one image, tile by tile if the image is larger than the tile size
+
+        :param img: img to process
+        """
+        if self.tile_size is None or (img.shape[0] <= self.tile_size and img.shape[1] <= self.tile_size):
+            with profiler.span("inference_image", shape=img.shape):
+                return self._SR_class.inference_image(img)
+        with profiler.span("tiled_inference", shape=img.shape, tile=self.tile_size):
+            return tiled_inference(self._SR_class.inference_image, img, self.tile_size, self.config.tile_overlap)
+
     @logger.catch  # type: ignore
     def process(self, img: np.ndarray) -> np.ndarray:
         """
@@ -115,108 +445,761 @@ class CCRestoration:
         :return:
         """
 
-        _target_size = (
-            math.ceil(img.shape[1] * self.config.target_scale),
-            math.ceil(img.shape[0] * self.config.target_scale),
-        )
-
-        img = self._SR_class.inference_image(img)
+        shape = img.shape
+        img = self.inference(img)
         PrintProgressLog().printProgress()
 
+        return self.resize_to_target(img, shape)
+
+    def resize_to_target(self, img: np.ndarray, shape: Tuple[int, ...]) -> np.ndarray:
+        """
+        Resize a model output to target_scale times the input shape
+
+        :param img: model output
+        :param shape: shape of the model input
+        """
         if abs(float(self.config.target_scale) - float(self.config.cc_model_scale)) < 1e-3:  # type: ignore
             return img
+        _target_size = (
+            math.ceil(shape[1] * self.config.target_scale),
+            math.ceil(shape[0] * self.config.target_scale),
+        )
+        with profiler.span("cv2.resize", size=_target_size):
+            return cv2.resize(img, _target_size, interpolation=cv2.INTER_LINEAR)
 
-        img = cv2.resize(img, _target_size, interpolation=cv2.INTER_LINEAR)
+    def inference_batch(self, imgs: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        Run the model once on a batch of same-sized uint8 BGR images
+
+        :param imgs: images to process, all with the same shape
+        """
+        model = self._SR_class
+        batch = np.stack([cv2.cvtColor(img, cv2.COLOR_BGR2RGB) for img in imgs])
+        with torch.inference_mode():
+            tensor = torch.from_numpy(batch).permute(0, 3, 1, 2).to(model.device).float().div_(255.0)
+            if model.fp16:
+                tensor = tensor.half()
+            if self.config.channels_last:
+                tensor = tensor.contiguous(memory_format=torch.channels_last)
+            with profiler.span("model.inference", batch=len(imgs), shape=imgs[0].shape):
+                output = model.inference(tensor)
+            # same conversion as SRBaseModel.inference_image
+            output = output.float().mul_(255.0).clamp_(0, 255).byte().permute(0, 2, 3, 1).cpu().numpy()
+        return [cv2.cvtColor(o, cv2.COLOR_RGB2BGR) for o in output]
+
+    def can_batch(self, img: np.ndarray) -> bool:
+        """
+        Whether img can go through inference_batch: uint8 and not split into tiles
+        """
+        return img.dtype == np.uint8 and (
+            self.tile_size is None or (img.shape[0] <= self.tile_size and img.shape[1] <= self.tile_size)
+        )
+
+    @logger.catch  # type: ignore
+    def process_batch(self, imgs: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        Process images in batched model calls of at most config.batch_size images,
+        falls back to one call per image when not batchable.
+        Images of different sizes are padded (edge replicate) to the largest one and cropped back.
+
+        :param imgs: images to process, all with the same number of channels
+        :return:
+        """
+        if len(imgs) == 1 or not all(self.can_batch(img) for img in imgs):
+            return [self.process(img) for img in imgs]
+
+        h = max(img.shape[0] for img in imgs)
+        w = max(img.shape[1] for img in imgs)
+        padded = [
+            img if img.shape[:2] == (h, w)
+            else cv2.copyMakeBorder(img, 0, h - img.shape[0], 0, w - img.shape[1], cv2.BORDER_REPLICATE)
+            for img in imgs
+        ]
+
+        results: List[np.ndarray] = []
+        batch_size = max(self.config.batch_size, 2)
+        for i in range(0, len(padded), batch_size):
+            outputs = self.inference_batch(padded[i: i + batch_size])
+            for output, img in zip(outputs, imgs[i: i + batch_size]):
+                scale = output.shape[0] / h
+                output = output[: round(img.shape[0] * scale), : round(img.shape[1] * scale)]
+                PrintProgressLog().printProgress()
+                results.append(self.resize_to_target(output, img.shape))
+        return results
 
-        return img
+    def process_alpha(self, img: np.ndarray, alpha_channel: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Process an image with alpha channel according to config.alpha_mode
+
+        sr: upscale the alpha channel with a second SR pass (best quality)
+        batch: upscale RGB and alpha in one batched model call
+        interpolate: upscale only RGB with the model, resize alpha with bicubic interpolation
+
+        :param img: 3 channels image
+        :param alpha_channel: alpha channel of the image
+        :return: 4 channels image, None if processing failed
+        """
+        mode = self.config.alpha_mode
+        if mode == "interpolate":
+            img = self.process(img)
+            if img is None:
+                return None
+            alpha = cv2.resize(alpha_channel, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_CUBIC)
+            return np.dstack((img, alpha))
 
-def sr_queue(config: XTConfig) -> None:
+        # Stack alpha channel into a 3-channel tensor (AAA)
+        alpha_tensor = np.dstack((alpha_channel, alpha_channel, alpha_channel))
+        if mode == "batch":
+            results = self.process_batch([img, alpha_tensor])
+            if results is None or any(r is None for r in results):
+                return None
+            img, alpha_tensor = results
+        else:
+            img = self.process(img)
+            if img is None:
+                return None
+            # Apply super-resolution to the alpha tensor
+            alpha_tensor = self.process(alpha_tensor)
+            if alpha_tensor is None:
+                return None
+        # Merge processed RGB channels with processed alpha tensor
+        return np.dstack((img, alpha_tensor[:, :, 0]))
+
+class StageTimes:
+    """
+    Accumulated wall time of each sr_queue pipeline stage, in seconds
     """
-    Super-resolution queue. Process all RGBA images according to the config.
 
-    :param config: XTConfig
-    :return:
+    def __init__(self) -> None:
+        self.decode = 0.0
+        self.inference = 0.0
+        self.encode = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            setattr(self, stage, getattr(self, stage) + seconds)
+
+    def log(self, wall: float) -> None:
+        utilization = self.inference / wall * 100 if wall > 0 else 0.0
+        logger.info(
+            f"Stage time: decode {self.decode:.2f}s, inference {self.inference:.2f}s, "
+            f"encode/write {self.encode:.2f}s, wall {wall:.2f}s, device utilization {utilization:.1f}%"
+        )
+
+
+def get_save_path(output_path: Path, img_path: Path, target_scale: Any, reserved: Set[str]) -> str:
     """
-    input_path: List[Path] = config.input_path
-    output_path: Path = config.output_path / "outputs"
-    output_path.mkdir(parents=True, exist_ok=True)  # create output folder
-    sr = CCRestoration(config)
+    Get a free save path for img_path, appending (i) if the file exists or is already reserved by a pending write
 
-    logger.info("Processing------[ 0.0% ]")
+    :param output_path: output folder
+    :param img_path: input image path
+    :param target_scale: target scale, used as file name prefix
+    :param reserved: save paths already handed out in this run
+    """
+    stem = Path(str(target_scale) + "x-" + Path(img_path).name).stem
+    save_path = str(output_path / (stem + ".png"))
 
-    for img_path in input_path:
-        save_path = str(output_path / (Path(str(config.target_scale) + "x-" + Path(img_path).name).stem + ".png"))
+    i: int = 0
+    while Path(save_path).is_file() or save_path in reserved:
+        logger.warning("Image already exists: " + save_path)
+        i += 1
+        save_path = str(output_path / (stem + "(" + str(i) + ").png"))
+        logger.warning("Try to save to: " + save_path)
 
-        i: int = 0
-        while Path(save_path).is_file():
-            logger.warning("Image already exists: " + save_path)
-            i += 1
-            save_path = str(
-                output_path
-                / (Path(str(config.target_scale) + "x-" + Path(img_path).name).stem + "(" + str(i) + ").png")
-            )
-            logger.warning("Try to save to: " + save_path)
+    reserved.add(save_path)
+    return save_path
 
-        if not Path(img_path).is_file():
-            logger.error("File not found: " + str(img_path) + ", skip. Save path: " + save_path)
-            logger.warning("______Skip_Image______: " + str(img_path))
-            PrintProgressLog().skipProgress()
 
-        else:
-            alpha_channel = None
+def decode_image(img_path: Path, data: Optional[np.ndarray] = None) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Decode an image into a 3 channels image and its alpha channel (None if the image has no alpha)
+
+    :param img_path: image path
+    :param data: file content already read from img_path, read from disk if None
+    """
+    # The file may not be read correctly.
+    # In unix-like system, the Filename Extension is not important.
+    if data is None:
+        data = np.fromfile(img_path, dtype=np.uint8)
+    with profiler.span("cv2.imdecode", bytes=int(data.nbytes)):
+        img = cv2.imdecode(data, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise Exception("Failed to decode image.")
+
+    alpha_channel = None
+    if len(img.shape) == 2:
+        logger.warning("Grayscale image detected, Convert to RGB image.")
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+
+    elif img.shape[2] == 4:
+        logger.warning("4 channels image detected.")
+        # Extract alpha channel
+        alpha_channel = img[:, :, 3]
+        # Remove alpha channel from the image
+        img = img[:, :, :3]
+
+    return img, alpha_channel
+
+
+class DecodedImage:
+    """
+    An item of the sr_queue pipeline. img is None if the image must be skipped or was found in the result cache,
+    skipped is set if it is unchanged since the last incremental run. memory_mb is the share of the memory budget
+    held until the output is written.
+    """
+
+    def __init__(
+        self,
+        img_path: Path,
+        save_path: str,
+        img: Optional[np.ndarray] = None,
+        alpha_channel: Optional[np.ndarray] = None,
+        cache_key: Optional[str] = None,
+        cached: bool = False,
+        skipped: bool = False,
+        memory_mb: float = 0.0,
+    ) -> None:
+        self.img_path = img_path
+        self.save_path = save_path
+        self.img = img
+        self.alpha_channel = alpha_channel
+        self.cache_key = cache_key
+        self.cached = cached
+        self.skipped = skipped
+        self.memory_mb = memory_mb
+
+
+def write_image(img: np.ndarray, save_path: str) -> None:
+    """
+    Encode img as PNG and write it to save_path
+
+    :param img: image to save
+    :param save_path: save path
+    """
+    with events.stage("encode", file=save_path) as record:
+        buf = cv2.imencode(".png", img)[1]
+        record["bytes_out"] = int(buf.nbytes)
+    with events.stage("write", file=save_path):
+        buf.tofile(save_path)
+
+
+def read_image_size(img_path: Path) -> Tuple[int, int]:
+    """
+    Read (width, height) from the image header without decoding pixels, (0, 0) if unreadable
+
+    :param img_path: image path
+    """
+    try:
+        with Image.open(img_path) as img:
+            return img.size
+    except Exception:
+        return 0, 0
+
+
+def batch_key(img: np.ndarray, pad: Optional[int]) -> Tuple[int, ...]:
+    """
+    Images with the same key can be processed in one batch
+
+    :param img: image to process
+    :param pad: bucket size, image sizes are rounded up to a multiple of it, None to batch only identical shapes
+    """
+    if not pad:
+        return img.shape
+    return (math.ceil(img.shape[0] / pad) * pad, math.ceil(img.shape[1] / pad) * pad) + img.shape[2:]
+
 
+def _decode_worker(
+    config: XTConfig,
+    inputs: Iterable[Tuple[Path, Optional[str]]],
+    output_path: Path,
+    decoded: queue.Queue,
+    times: StageTimes,
+    cache: Optional[ResultCache],
+    cache_params: Dict[str, Any],
+    incremental: Optional[IncrementalManifest],
+    budget: Optional[MemoryBudget] = None,
+) -> None:
+    """
+    Producer of the sr_queue pipeline, decodes images ahead of inference into a bounded queue of DecodedImage.
+    Inputs unchanged since the last incremental run are passed through without decoding.
+
+    :param inputs: (input path, save path) pairs, a free save path is chosen here when it is None
+    :param cache_params: parameters of the result cache key, from CCRestoration.cache_params
+    :param budget: memory budget, before decoding an image its estimated memory (read from the header) is
+        reserved, so a large image waits until the images ahead of it are written
+    """
+    reserved: Set[str] = set()
+    try:
+        for img_path, save_path in inputs:
+            previous = incremental.unchanged(img_path) if incremental is not None else None
+            if previous is not None:
+                decoded.put(DecodedImage(img_path, previous[0], cached=True, skipped=True))
+                continue
+
+            if save_path is None:
+                save_path = get_save_path(output_path, img_path, config.target_scale, reserved)
+
+            if not Path(img_path).is_file():
+                logger.error("File not found: " + str(img_path) + ", skip. Save path: " + save_path)
+                decoded.put(DecodedImage(img_path, save_path))
+                continue
+
+            start = time.perf_counter()
+            memory_mb = 0.0
             try:
-                # The file may not be read correctly.
-                # In unix-like system, the Filename Extension is not important.
-                img = cv2.imdecode(np.fromfile(img_path, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
-
-                if len(img.shape) == 2:
-                    logger.warning("Grayscale image detected, Convert to RGB image.")
-                    img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
-
-                elif img.shape[2] == 4:
-                    logger.warning("4 channels image detected.")
-                    PrintProgressLog().Total += PrintProgressLog().sr_n
-                    # Extract alpha channel
-                    alpha_channel = img[:, :, 3]
-                    # Remove alpha channel from the image
-                    img = img[:, :, :3]
-
-                if img is None:
-                    raise Exception("Failed to decode image.")
+                data = np.fromfile(img_path, dtype=np.uint8)
+                cache_key = None
+                if cache is not None:
+                    cache_key = cache.make_key("final2x", cache_params, data=data)
+                    if cache.get(cache_key, save_path):
+                        logger.info("Result cache hit: " + str(img_path) + ", save to: " + save_path)
+                        decoded.put(DecodedImage(img_path, save_path, cached=True))
+                        continue
+                if budget is not None:
+                    header = read_header(img_path)
+                    memory_mb = final2x_bytes(header, config) / (1024 * 1024) if header is not None else 0.0
+                    budget.acquire(memory_mb)
+                with events.stage("decode", file=str(img_path), bytes_in=int(data.nbytes)):
+                    img, alpha_channel = decode_image(img_path, data)
             except Exception as e:
+                if budget is not None:
+                    budget.release(memory_mb)
                 logger.error(str(e))
                 logger.warning("CV2 load image failed: " + str(img_path) + ", skip. ")
-                logger.warning("______Skip_Image______: " + str(img_path))
+                decoded.put(DecodedImage(img_path, save_path))
+                continue
+            times.add("decode", time.perf_counter() - start)
+
+            decoded.put(DecodedImage(img_path, save_path, img, alpha_channel, cache_key, memory_mb=memory_mb))
+    finally:
+        decoded.put(None)
+
+
+def _sr_loop(
+    config: XTConfig,
+    sr: CCRestoration,
+    decoded: queue.Queue,
+    times: StageTimes,
+    cache: Optional[ResultCache],
+    add_result: Callable[[FileResult], None],
+    budget: Optional[MemoryBudget] = None,
+) -> None:
+    """
+    Consumer of the sr_queue pipeline, runs inference on the decoded images back-to-back
+    and hands PNG encoding and writing to a thread pool (config.encode_workers)
+
+    :param budget: memory budget shared with the producer, an image's share is released once it is written
+    """
+
+    def release(item: DecodedImage) -> None:
+        if budget is not None:
+            budget.release(item.memory_mb)
+            item.memory_mb = 0.0
+
+    def write(img: np.ndarray, item: DecodedImage, start: float) -> FileResult:
+        encode_start = time.perf_counter()
+        try:
+            write_image(img, item.save_path)
+        finally:
+            release(item)
+        times.add("encode", time.perf_counter() - encode_start)
+        if cache is not None and item.cache_key is not None:
+            cache.put(item.cache_key, item.save_path)
+        logger.success("______Process_Completed______: " + str(item.img_path))
+        return FileResult(input_path=str(item.img_path), output_paths=[item.save_path], success=True,
+                          elapsed=time.perf_counter() - start)
+
+    def collect(future: Future, img_path: Path) -> None:
+        try:
+            add_result(future.result())
+        except Exception as e:
+            logger.error("Failed to write image: " + str(img_path) + ", " + str(e))
+            add_result(FileResult(input_path=str(img_path), success=False, error=str(e)))
+
+    pending: "deque[Tuple[Future, Path]]" = deque()
+    group: List[DecodedImage] = []
+
+    def submit(img: Optional[np.ndarray], item: DecodedImage, start: float) -> None:
+        if img is None:
+            release(item)
+            add_result(FileResult(input_path=str(item.img_path), success=False, error="inference failed"))
+            return
+        # Keep the number of images waiting to be encoded bounded
+        while len(pending) >= config.encode_workers * 2:
+            collect(*pending.popleft())
+        pending.append((executor.submit(write, img, item, start), item.img_path))
+
+    def flush() -> None:
+        if not group:
+            return
+        start = time.perf_counter()
+        with events.stage("inference", files=[str(item.img_path) for item in group], batch=len(group)):
+            outputs = sr.process_batch([item.img for item in group])
+        if outputs is None:
+            outputs = [None] * len(group)
+        times.add("inference", time.perf_counter() - start)
+        for item, output in zip(group, outputs):
+            submit(output, item, start)
+        group.clear()
+
+    with ThreadPoolExecutor(max_workers=config.encode_workers) as executor:
+        while True:
+            try:
+                # with an incomplete batch, the producer may be waiting for memory held by that batch
+                item = decoded.get(timeout=0.1) if group and budget is not None else decoded.get()
+            except queue.Empty:
+                if budget.waiting:
+                    flush()
+                continue
+            if item is None:
+                break
+
+            if item.cached:
                 PrintProgressLog().skipProgress()
+                add_result(FileResult(input_path=str(item.img_path), output_paths=[item.save_path],
+                                      success=True, skipped=item.skipped))
+                continue
+
+            if item.img is None:
+                logger.warning("______Skip_Image______: " + str(item.img_path))
+                PrintProgressLog().skipProgress()
+                add_result(FileResult(input_path=str(item.img_path), success=False, error="skipped"))
+                continue
+
+            logger.info("Processing: " + str(item.img_path) + ", save to: " + item.save_path)
+            if config.batch_size > 1 and item.alpha_channel is None and sr.can_batch(item.img):
+                if group and batch_key(group[0].img, config.batch_pad) != batch_key(item.img, config.batch_pad):
+                    flush()
+                group.append(item)
+                if len(group) >= config.batch_size:
+                    flush()
                 continue
 
-            logger.info("Processing: " + str(img_path) + ", save to: " + save_path)
-            img = sr.process(img)
+            start = time.perf_counter()
+            with events.stage("inference", file=str(item.img_path)):
+                if item.alpha_channel is None:
+                    img = sr.process(item.img)
+                else:
+                    if config.alpha_mode != "interpolate":
+                        PrintProgressLog().addTotal(PrintProgressLog().sr_n)
+                    img = sr.process_alpha(item.img, item.alpha_channel)
+            item.img = item.alpha_channel = None  # release the decoded image early
+            times.add("inference", time.perf_counter() - start)
+            submit(img, item, start)
 
-            if alpha_channel is not None:
-                # Stack alpha channel into a 3-channel tensor (AAA)
-                alpha_tensor = np.dstack((alpha_channel, alpha_channel, alpha_channel))
-                # Apply super-resolution to the alpha tensor
-                alpha_tensor = sr.process(alpha_tensor)
-                # Merge processed RGB channels with processed alpha tensor
-                img = np.dstack((img, alpha_tensor[:, :, 0]))
+        flush()
+        while pending:
+            collect(*pending.popleft())
 
-            cv2.imencode(".png", img)[1].tofile(save_path)
 
-            logger.success("______Process_Completed______: " + str(img_path))
+def list_inputs(config: XTConfig, largest_first: bool = False) -> Tuple[Iterable[Path], Optional[int]]:
+    """
+    Inputs of a final2x run and their number. Directory and glob inputs are finite and listed up front,
+    a manifest is streamed with an unknown total (None).
+
+    :param largest_first: order listed inputs by pixel count, largest first
+    """
+    input_path: Iterable[Path] = config.iter_inputs()
+    if config.manifest is not None:
+        return input_path, None
+    input_path = list(input_path)
+    if largest_first:
+        input_path.sort(key=lambda p: math.prod(read_image_size(p)), reverse=True)
+    elif config.batch_size > 1:
+        # When batching, order inputs by size so that same-sized images arrive together
+        input_path.sort(key=read_image_size)
+    return input_path, len(input_path)
+
+
+def sr_queue(config: XTConfig) -> BatchReport:
+    """
+    Super-resolution queue. Process all RGBA images according to the config.
+
+    Decoding runs ahead in a producer thread (bounded by config.prefetch), PNG encoding and writing
+    run in a thread pool (config.encode_workers), so inference runs back-to-back.
+
+    :param config: XTConfig
+    :return: per-file results
+    """
+    output_path: Path = config.output_path / config.OUTPUT_DIR
+    output_path.mkdir(parents=True, exist_ok=True)  # create output folder
+    input_path, total_file = list_inputs(config)
+
+    sr = CCRestoration(config, total_file)
+    cache = open_cache(config)
+    incremental = open_incremental("final2x", config)
+    report = BatchReport(command="final2x")
+    times = StageTimes()
+
+    logger.info("Processing------[ 0.0% ]")
+
+    wall_start = time.perf_counter()
+    events.emit("batch_start", command="final2x", total=total_file)
+    budget = MemoryBudget(config.memory_budget_mb) if config.memory_budget_mb is not None else None
+    decoded: queue.Queue = queue.Queue(maxsize=config.prefetch)
+    producer = threading.Thread(
+        target=_decode_worker,
+        args=(config, ((p, None) for p in input_path), output_path, decoded, times, cache, sr.cache_params(),
+              incremental, budget),
+        daemon=True,
+    )
+    producer.start()
+
+    def add_result(result: FileResult) -> None:
+        report.results.append(result)
+        events.emit_file("final2x", result, len(report.results), time.perf_counter() - wall_start)
+
+    torch_profile: Any = contextlib.nullcontext()
+    if profiler.torch_enabled():
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        torch_profile = torch.profiler.profile(activities=activities, record_shapes=True)
+
+    with torch_profile as torch_prof:
+        _sr_loop(config, sr, decoded, times, cache, add_result, budget)
+
+    producer.join()
+    if torch_prof is not None:
+        torch_prof.export_chrome_trace(profiler.torch_trace_path())
+        logger.info("torch profiler trace saved to: " + profiler.torch_trace_path())
+    return _finish_report(report, incremental, times, wall_start)
+
+
+def _finish_report(report: BatchReport, incremental: Optional[IncrementalManifest], times: Optional[StageTimes],
+                   wall_start: float) -> BatchReport:
+    """
+    Record the incremental results and emit the batch summary
+
+    :param times: stage times to log, None when every sharded worker logged its own
+    """
+    if incremental is not None:
+        for result in report.results:
+            if result.success and not result.skipped:
+                incremental.record(result.input_path, result.output_paths)
+        incremental.save()
+        logger.info("Unchanged since last run, skipped: " + str(report.skipped))
+    report.elapsed = time.perf_counter() - wall_start
+    if times is not None:
+        times.log(report.elapsed)
+    events.emit("batch_end", command="final2x", files=len(report.results), succeeded=report.succeeded,
+                failed=report.failed, skipped=report.skipped, elapsed=report.elapsed,
+                throughput=report.throughput, peak_rss_mb=events.peak_rss_mb())
+    return report
+
+
+def _shard_worker(config: XTConfig, index: int, threads: int, tasks: Any, messages: Any) -> None:
+    """
+    Worker process of the sharded mode. Loads its own model on config.devices[index], then pulls
+    (input path, save path) tasks from the shared queue until it gets None. Results, progress steps
+    and events are sent back to the main process through messages.
+    """
+    device = config.devices[index]
+    # the memory budget is split evenly between the workers
+    budget = MemoryBudget(config.memory_budget_mb / len(config.devices)) if config.memory_budget_mb else None
+    config = config.model_copy(update={"device": device, "devices": [], "torch_threads": threads})
+    cv2.setNumThreads(threads)
+    PrintProgressLog().forward = lambda *message: messages.put(message)
+    if events.enabled():
+        events.forward(lambda line: messages.put(("event", line)))
+    try:
+        sr = CCRestoration(config)
+    except Exception as e:
+        logger.error("Failed to load SR model on " + device + ": " + str(e))
+        messages.put(("failed", index, str(e)))
+        return
+
+    start = time.perf_counter()
+    cache = open_cache(config)
+    times = StageTimes()
+    decoded: queue.Queue = queue.Queue(maxsize=config.prefetch)
+    producer = threading.Thread(
+        target=_decode_worker,
+        args=(config, iter(tasks.get, None), config.output_path / config.OUTPUT_DIR, decoded, times, cache,
+              sr.cache_params(), None, budget),
+        daemon=True,
+    )
+    producer.start()
+    _sr_loop(config, sr, decoded, times, cache, lambda result: messages.put(("result", result.model_dump())),
+             budget)
+    producer.join()
+    logger.info("Worker on " + device + " finished")
+    times.log(time.perf_counter() - start)
+    profiler.flush()
+    messages.put(("done", index))
+
 
-def final2x_image(config: XTConfig):
+def sr_sharded(config: XTConfig) -> BatchReport:
+    """
+    Sharded super-resolution queue: one worker process per entry of config.devices (several CUDA GPUs,
+    or several CPU workers), each with its own model instance and a share of the CPU threads.
+
+    Workers pull images from one shared queue, so a worker that finishes early takes the next image
+    instead of idling; listed inputs are queued largest first so the big images don't end up last.
+    Save paths are chosen here so that workers never write to the same file, and the workers' progress
+    is counted here into one progress log.
+
+    :param config: XTConfig
+    :return: per-file results
+    """
+    output_path: Path = config.output_path / config.OUTPUT_DIR
+    output_path.mkdir(parents=True, exist_ok=True)
+    input_path, total_file = list_inputs(config, largest_first=True)
+    PrintProgressLog().set(total_file, 1)
+    incremental = open_incremental("final2x", config)
+    report = BatchReport(command="final2x", workers=len(config.devices))
+    lock = threading.Lock()
+
+    # Per-worker thread budget: the CPU cores are split between the workers
+    threads = config.torch_threads or max(1, (os.cpu_count() or 1) // len(config.devices))
+    ctx = multiprocessing.get_context("spawn")
+    # bounded, so a streamed manifest is read only as fast as the workers take images
+    tasks, messages = ctx.Queue(maxsize=_SHARD_QUEUE_PER_WORKER * len(config.devices)), ctx.Queue()
+    workers = [
+        ctx.Process(target=_shard_worker, args=(config, i, threads, tasks, messages), daemon=True)
+        for i in range(len(config.devices))
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Sharded over {len(workers)} workers: {', '.join(config.devices)}, {threads} threads each")
+    logger.info("Processing------[ 0.0% ]")
+
+    wall_start = time.perf_counter()
+    events.emit("batch_start", command="final2x", total=total_file, workers=len(workers))
+
+    # Images handed to the workers and not reported yet: input path -> save paths (an input may be listed twice).
+    # Save paths stay reserved only while in flight, a written file is found on disk by get_save_path.
+    in_flight: Dict[str, List[str]] = {}
+    reserved: Set[str] = set()
+    stopped = threading.Event()
+
+    def add_result(result: FileResult, queued: bool = True) -> None:
+        with lock:
+            save_paths = in_flight.get(result.input_path) if queued else None
+            if save_paths:
+                reserved.discard(save_paths.pop(0))
+                if not save_paths:
+                    del in_flight[result.input_path]
+            report.results.append(result)
+            events.emit_file("final2x", result, len(report.results), time.perf_counter() - wall_start)
+
+    def put(task: Any) -> bool:
+        """Put a task, waiting for room in the queue, gives up once the workers are gone"""
+        while not stopped.is_set():
+            try:
+                tasks.put(task, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def feed() -> None:
+        try:
+            for img_path in input_path:
+                previous = incremental.unchanged(img_path) if incremental is not None else None
+                if previous is not None:
+                    with lock:
+                        PrintProgressLog().skipProgress()
+                    add_result(FileResult(input_path=str(img_path), output_paths=previous, success=True,
+                                          skipped=True), queued=False)
+                    continue
+                if stopped.is_set():
+                    # every worker is gone, the rest of the inputs are reported as failed
+                    add_result(FileResult(input_path=str(img_path), success=False, error="worker exited"),
+                               queued=False)
+                    continue
+                with lock:
+                    save_path = get_save_path(output_path, img_path, config.target_scale, reserved)
+                    in_flight.setdefault(str(img_path), []).append(save_path)
+                put((img_path, save_path))  # stays in flight if it could not be queued, reported below
+        finally:
+            for _ in workers:
+                if not put(None):
+                    break
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    finished: Set[int] = set()
+    while len(finished) < len(workers):
+        try:
+            message = messages.get(timeout=1)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break  # a worker died without reporting
+            continue
+        kind = message[0]
+        if kind == "result":
+            add_result(FileResult(**message[1]))
+        elif kind == "progress":
+            with lock:
+                PrintProgressLog().printProgress()
+        elif kind == "total":
+            with lock:
+                PrintProgressLog().addTotal(message[1])
+        elif kind == "event":
+            events.write_line(message[1])
+        elif kind == "failed":
+            logger.error("Worker on " + config.devices[message[1]] + " failed: " + message[2])
+            finished.add(message[1])
+        elif kind == "done":
+            finished.add(message[1])
+
+    stopped.set()
+    feeder.join()
+    for worker in workers:
+        worker.join(timeout=5)
+    # Inputs taken by a worker that died, or left in the queue when every worker failed
+    for img_path, save_paths in list(in_flight.items()):
+        for _ in list(save_paths):
+            add_result(FileResult(input_path=img_path, success=False, error="worker exited"))
+    return _finish_report(report, incremental, None, wall_start)
+
+
+def final2x_image(config: XTConfig) -> BatchReport:
     logger.info("config loaded")
     logger.debug("output path: " + str(config.output_path))
-    sr_queue(config)
+    report = sr_sharded(config) if len(config.devices) > 1 else sr_queue(config)
     logger.success("______SR_COMPLETED______")
+    return report
+
+def resolve_scale(config: XTConfig) -> None:
+    """
+    Fill cc_model_scale from the model config, and target_scale if it is not set
+
+    :param config: Final2xConfig or Final2xStage
+    """
+    c: BaseConfig = AutoConfig.from_pretrained(pretrained_model_name=config.pretrained_model_name)
+    config.cc_model_scale = c.scale
+    if config.target_scale is None or config.target_scale <= 0:
+        config.target_scale = c.scale
+
+
+def upscale_pil(img: Image.Image, config: XTConfig) -> Image.Image:
+    """
+    Super-resolve a PIL image in memory, keeping its alpha channel
+
+    :param img: image to process
+    :param config: Final2xStage with resolved scales
+    """
+    sr = CCRestoration(config, total_file=1)
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+    arr = np.asarray(img.convert("RGBA" if has_alpha else "RGB"))
+    if has_alpha:
+        PrintProgressLog().addTotal(PrintProgressLog().sr_n)
+        out = sr.process_alpha(cv2.cvtColor(arr[:, :, :3], cv2.COLOR_RGB2BGR), np.ascontiguousarray(arr[:, :, 3]))
+        if out is None:
+            raise Exception("Super-resolution failed.")
+        return Image.fromarray(cv2.cvtColor(out, cv2.COLOR_BGRA2RGBA), "RGBA")
+    out = sr.process(cv2.cvtColor(arr, cv2.COLOR_RGB2BGR))
+    if out is None:
+        raise Exception("Super-resolution failed.")
+    return Image.fromarray(cv2.cvtColor(out, cv2.COLOR_BGR2RGB), "RGB")
+
 
 def final2x_progress(config: XTConfig):
     if config.final2xConfig is None:
         return False
-    c: BaseConfig = AutoConfig.from_pretrained(pretrained_model_name=config.final2xConfig.pretrained_model_name)
-    config.final2xConfig.cc_model_scale = c.scale
-    if config.final2xConfig.target_scale is None or config.final2xConfig.target_scale <= 0:
-        config.final2xConfig.target_scale = c.scale
-    final2x_image(config.final2xConfig)
\ No newline at end of file
+    resolve_scale(config.final2xConfig)
+    return final2x_image(config.final2xConfig)
\ No newline at end of file
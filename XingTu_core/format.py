@@ -1,9 +1,17 @@
-from config import XTConfig
+from config import XTConfig, FormatTarget
+from batch import BatchReport, run_batch
+from cache import ResultCache, open_cache
+from incremental import open_incremental
+from planner import open_planner
+from events import output_size, stage
+from resize import decode_reduced
+from animation import convert_animation, is_animated, supports_animation
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 import pillow_avif
 import pillow_heif
 from pillow_heif import register_heif_opener
-from typing import Optional, Tuple
+from typing import BinaryIO, List, Optional, Tuple, Union
 import os
 import sys
 import uuid
@@ -65,60 +73,161 @@ def get_output_filename(input_path: str, output_path: str, target_format: str) -
     return base_name, os.path.join(output_path, unique_name)
 
 
-def format_image(input_path: str, output_path: str, target_format: str) -> Optional[str]:
-    """格式化图片
+def save_formatted(img: Image.Image, output_file: Union[str, BinaryIO], target_format: str, quality: Optional[int] = None,
+                   **options) -> None:
+    """按目标格式保存图片
+
+    Args:
+        img: 输入的PIL图像对象
+        output_file: 输出文件路径或可写的二进制缓冲
+        target_format: 目标格式
+        quality: 编码质量，为空时使用该格式的默认质量
+        options: 透传给编码器的其他参数
+    """
+    # 格式特定处理
+    format_lower = target_format.lower()
+
+    if format_lower in ('jpg', 'jpeg'):
+        img = handle_transparency(img)
+        img = img.convert('RGB')
+        img.save(output_file, 'JPEG', quality=quality or 95, **options)
+    elif format_lower == 'ico':
+        sizes = [(16, 16), (32, 32), (48, 48), (64, 64)]
+        if max(img.size) > 256:
+            img = img.copy()  # 多个目标共用同一张解码后的图片，不能原地缩放
+            img.thumbnail((256, 256), Image.LANCZOS)
+        img.save(output_file, format='ICO', sizes=sizes, **options)
+    elif format_lower in ('tif', 'tiff'):
+        img.save(output_file, 'TIFF', **{'compression': 'tiff_lzw', **options})
+    elif format_lower == 'avif':
+        img.save(output_file, 'AVIF', quality=quality or 80, **options)
+    elif format_lower == 'heic':
+        # 使用 pillow_heif 保存为 HEIC
+        heif_img = pillow_heif.from_pillow(img)
+        heif_img.save(output_file, quality=quality or 90, **options)  # quality 可选 (1-100)
+    elif format_lower == 'apng':
+        img.save(output_file, 'PNG', **options)  # 单帧图片按普通 PNG 保存
+    else:
+        if quality is not None:
+            options['quality'] = quality
+        img.save(output_file, format_lower.upper(), **options)
+
+
+def _save_target(img: Image.Image, output_file: Union[str, BinaryIO], target: FormatTarget) -> None:
+    with stage("encode", format=target.format.lower()) as record:
+        save_formatted(img, output_file, target.format, target.quality, **target.options)
+        record["bytes_out"] = output_size(output_file)
+
+
+def save_targets(img: Image.Image, output_files: List[Union[str, BinaryIO]], targets: List[FormatTarget]) -> None:
+    """将同一张解码后的图片并发编码为多个目标格式
+
+    Pillow 的编码器在编码时会释放 GIL，AVIF、HEIC 等较慢的编码可以在线程中并行。
+
+    Args:
+        img: 输入的PIL图像对象
+        output_files: 输出文件路径或二进制缓冲列表，与 targets 一一对应
+        targets: 目标格式列表
+    """
+    img.load()  # 在各线程共享之前完成解码
+    if len(targets) == 1:
+        _save_target(img, output_files[0], targets[0])
+        return
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = [executor.submit(_save_target, img, f, t) for f, t in zip(output_files, targets)]
+        for future in futures:
+            future.result()
+
+
+# ICO 最大只保存 256x256
+_ICO_MAX_SIZE = 256
+
+
+def decode_size(targets: List[FormatTarget], max_size: Optional[int] = None) -> Optional[int]:
+    """解码时的最长边上限: 所有目标都是 ICO 时只需解码到 256 像素"""
+    if all(t.format.lower() == 'ico' for t in targets):
+        return min(max_size or _ICO_MAX_SIZE, _ICO_MAX_SIZE)
+    return max_size
+
+
+def target_cache_params(target: FormatTarget) -> dict:
+    params = {"format": target.format.lower()}
+    if target.quality is not None:
+        params["quality"] = target.quality
+    if target.options:
+        params["options"] = target.options
+    return params
+
+
+def format_image(input_path: str, output_path: str, targets: List[FormatTarget],
+                 cache: Optional[ResultCache] = None, max_size: Optional[int] = None) -> List[str]:
+    """格式化图片，只解码一次，输出所有目标格式
 
     Args:
         input_path: 输入文件路径
         output_path: 输出目录路径
-        target_format: 目标格式
+        targets: 目标格式列表
+        cache: 结果缓存，命中的目标直接复制缓存的结果
+        max_size: 输出图片最长边上限，JPEG 输入在解码时直接缩小
 
     Returns:
-        成功返回输出文件路径，失败返回None
+        成功返回输出文件路径列表，失败返回None
     """
     try:
-        # 打开图片并处理
-        with Image.open(input_path) as img:
-            base_name, new_output_path = get_output_filename(input_path, output_path, target_format)
-
-            # 格式特定处理
-            format_lower = target_format.lower()
-            print(f"图片保存至: {new_output_path}")
-
-            if format_lower in ('jpg', 'jpeg'):
-                img = handle_transparency(img)
-                img = img.convert('RGB')
-                img.save(new_output_path, 'JPEG', quality=95)
-            elif format_lower == 'ico':
-                sizes = [(16, 16), (32, 32), (48, 48), (64, 64)]
-                if max(img.size) > 256:
-                    img.thumbnail((256, 256), Image.LANCZOS)
-                img.save(new_output_path, format='ICO', sizes=sizes)
-            elif format_lower in ('tif', 'tiff'):
-                img.save(new_output_path, 'TIFF', compression='tiff_lzw')
-            elif format_lower == 'avif':
-                img.save(new_output_path, 'AVIF', quality=80)
-            elif format_lower == 'heic':
-                # 使用 pillow_heif 保存为 HEIC
-                heif_img = pillow_heif.from_pillow(img)
-                heif_img.save(new_output_path, quality=90)  # quality 可选 (1-100)
-            else:
-                img.save(new_output_path, format_lower.upper())
-
-            return new_output_path
+        output_files = {}
+        cache_keys = {}
+        if cache is not None:
+            with open(input_path, 'rb') as f:
+                data = f.read()
+            for i, target in enumerate(targets):
+                cache_keys[i] = cache.make_key("format", {**target_cache_params(target), "max_size": max_size},
+                                               data=data)
+                _, cached_path = get_output_filename(input_path, output_path, target.format)
+                if cache.get(cache_keys[i], cached_path):
+                    print(f"命中缓存, 图片保存至: {cached_path}")
+                    output_files[i] = cached_path
+
+        missing = [i for i in range(len(targets)) if i not in output_files]
+        if missing:
+            # 打开图片并处理
+            saved = [get_output_filename(input_path, output_path, targets[i].format)[1] for i in missing]
+            missing_targets = [targets[i] for i in missing]
+            with Image.open(input_path) as img:
+                # 动画输入转换为支持动画的目标格式时保留所有帧，其他目标只使用第一帧
+                animated = [k for k, t in enumerate(missing_targets)
+                            if is_animated(img) and supports_animation(t.format)]
+                if animated:
+                    convert_animation(img, [saved[k] for k in animated], [missing_targets[k] for k in animated],
+                                      max_size)
+                    img.seek(0)
+                still = [k for k in range(len(missing_targets)) if k not in animated]
+                if still:
+                    still_targets = [missing_targets[k] for k in still]
+                    with stage("decode", bytes_in=os.path.getsize(input_path)):
+                        img = decode_reduced(img, decode_size(still_targets, max_size))
+                    save_targets(img, [saved[k] for k in still], still_targets)
+            for i, new_output_path in zip(missing, saved):
+                print(f"图片保存至: {new_output_path}")
+                output_files[i] = new_output_path
+                if i in cache_keys:
+                    cache.put(cache_keys[i], new_output_path)
+
+        return [output_files[i] for i in range(len(targets))]
 
     except Exception as e:
         print(f"处理图片出错: {str(e)}", file=sys.stderr)
         return None
 
 
-def format_progress(config: XTConfig):
+def format_progress(config: XTConfig) -> Union[BatchReport, bool]:
     if config.formatConfig is None:
         return False
-    if config.formatConfig.target_format is None:
-        config.formatConfig.target_format = "png"
-    output_path = config.formatConfig.output_path.joinpath("format")
+    output_path = config.formatConfig.output_path.joinpath(config.formatConfig.OUTPUT_DIR)
     if not output_path.exists():
         output_path.mkdir(exist_ok=True, parents=True)
-    success = format_image(config.formatConfig.input_path[0], output_path, config.formatConfig.target_format)
-    sys.exit(0 if success else 1)
+    cache = open_cache(config.formatConfig)
+    targets = config.formatConfig.get_targets()
+    tasks = ((format_image, str(p), (str(output_path), targets, cache, config.formatConfig.max_size))
+             for p in config.formatConfig.iter_inputs())
+    return run_batch("format", tasks, config.formatConfig.workers, open_incremental("format", config.formatConfig),
+                     open_planner("format", config.formatConfig), config.formatConfig.input_total())
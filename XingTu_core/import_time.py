@@ -0,0 +1,68 @@
+"""
+启动耗时分析: 统计执行某个命令需要导入的模块及各自的导入耗时
+
+用法:
+    python XingTu_core/import_time.py compress
+    python XingTu_core/import_time.py final2x --top 30
+    python XingTu_core/import_time.py compress --max-ms 500   # 超过阈值时返回非零退出码，可用于 CI 防止回退
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from typing import List, Tuple
+
+from progress import COMMANDS
+
+_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def measure(command: str) -> List[Tuple[int, int, int, str]]:
+    """
+    在新的解释器中导入 __main__ 依赖的模块及该命令的模块，返回 -X importtime 的解析结果
+
+    :return: [(自身耗时us, 累计耗时us, 嵌套层级, 模块名)]
+    """
+    code = f"import config, progress; progress.preload({command!r})"
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "import failed")
+    rows = []
+    for line in proc.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((int(self_us), int(cumulative_us), (len(indent) - 1) // 2, name))
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="命令启动导入耗时分析")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    parser.add_argument("--top", type=int, default=15, help="显示耗时最多的前 N 个顶层模块")
+    parser.add_argument("--max-ms", type=float, default=None, help="总导入耗时阈值(毫秒)")
+    args = parser.parse_args()
+
+    rows = measure(args.command)
+    top_level = [r for r in rows if r[2] == 0]
+    total_ms = sum(r[1] for r in top_level) / 1000
+
+    print(f"命令 {args.command} 导入耗时: {total_ms:.1f} ms ({len(rows)} 个模块)")
+    print(f"{'累计(ms)':>10} {'自身(ms)':>10}  模块")
+    for self_us, cumulative_us, _, name in sorted(top_level, key=lambda r: r[1], reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1000:>10.1f} {self_us / 1000:>10.1f}  {name}")
+
+    if args.max_ms is not None and total_ms > args.max_ms:
+        print(f"导入耗时 {total_ms:.1f} ms 超过阈值 {args.max_ms:.1f} ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
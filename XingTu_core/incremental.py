@@ -0,0 +1,118 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+# 增量记录保存在输出目录下，按命令及处理参数区分，参数改变后所有文件都会重新处理
+INCREMENTAL_DIR = ".xingtu"
+
+# 每记录多少个文件写一次磁盘，中途中断时已完成的文件不会丢失
+_SAVE_INTERVAL = 100
+
+
+def file_hash(path: Union[str, Path]) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class IncrementalManifest:
+    """
+    增量处理记录: 输入文件路径 -> 大小、修改时间、内容哈希及输出文件
+
+    文件大小与修改时间均未改变时直接跳过；只有修改时间改变时再比较内容哈希，
+    因此未改变的文件不需要重新读取。
+    """
+
+    def __init__(self, manifest_path: Union[str, Path]):
+        self.manifest_path = Path(manifest_path)
+        self.entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        if self.manifest_path.is_file():
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"读取增量记录失败, 将重新处理所有文件: {e}")
+
+    @staticmethod
+    def _key(input_path: Union[str, Path]) -> str:
+        return os.path.abspath(input_path)
+
+    def unchanged(self, input_path: Union[str, Path]) -> Optional[List[str]]:
+        """
+        判断输入文件自上次处理后是否未改变
+
+        Returns:
+            未改变且上次的输出文件仍然存在时返回输出文件列表，否则返回 None
+        """
+        key = self._key(input_path)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(input_path)
+        except OSError:
+            return None
+        if stat.st_size != entry["size"]:
+            return None
+        if not all(os.path.isfile(p) for p in entry["outputs"]):
+            return None
+        if stat.st_mtime_ns != entry["mtime_ns"]:
+            if file_hash(input_path) != entry["sha256"]:
+                return None
+            with self._lock:
+                entry["mtime_ns"] = stat.st_mtime_ns
+                self._touched()
+        return entry["outputs"]
+
+    def record(self, input_path: Union[str, Path], output_paths: List[str]) -> None:
+        """记录处理成功的输入文件"""
+        try:
+            stat = os.stat(input_path)
+            digest = file_hash(input_path)
+        except OSError:
+            return
+        with self._lock:
+            self.entries[self._key(input_path)] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sha256": digest,
+                "outputs": [os.path.abspath(p) for p in output_paths],
+            }
+            self._touched()
+
+    def _touched(self) -> None:
+        self._unsaved += 1
+        if self._unsaved >= _SAVE_INTERVAL:
+            self._save()
+
+    def save(self) -> None:
+        with self._lock:
+            if self._unsaved:
+                self._save()
+
+    def _save(self) -> None:
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_name(f"{self.manifest_path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+        self._unsaved = 0
+
+
+def open_incremental(command: str, config) -> Optional[IncrementalManifest]:
+    """根据 BaseConfig 中的 incremental 打开增量记录，未开启时返回 None"""
+    if not config.incremental:
+        return None
+    from config import BaseConfig
+
+    params = config.model_dump(mode="json", exclude=set(BaseConfig.model_fields))
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return IncrementalManifest(Path(config.output_path) / INCREMENTAL_DIR / f"{command}-{digest[:16]}.json")
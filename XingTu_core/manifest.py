@@ -0,0 +1,92 @@
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Iterator
+import glob
+import json
+import os
+import sys
+
+
+def iter_manifest(source: str) -> Iterator[Path]:
+    """
+    逐行读取 JSON-lines 输入清单
+
+    每行可以是一个路径字符串，或 {"input_path": 路径或路径列表}。
+    清单按需读取，内存占用与清单长度无关；路径不在此处校验，不存在的文件在处理时记为失败。
+    格式错误的行会被跳过并输出到标准错误。
+
+    :param source: 清单文件路径，"-" 表示标准输入
+    """
+    stream = sys.stdin if source == "-" else open(source, "r", encoding="utf-8")
+    try:
+        for line_no, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+                paths = entry["input_path"] if isinstance(entry, dict) else entry
+                if isinstance(paths, str):
+                    paths = [paths]
+                if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+                    raise ValueError("input_path must be a string or a list of strings")
+            except (ValueError, KeyError) as e:
+                print(f"清单第 {line_no} 行格式错误, 已跳过: {e}", file=sys.stderr)
+                continue
+            for path in paths:
+                yield Path(path)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def _is_within(path: Path, parent: Path) -> bool:
+    try:
+        path.relative_to(parent)
+        return True
+    except ValueError:
+        return False
+
+
+def _glob_root(pattern: str) -> Path:
+    """glob 模式中第一个通配符之前的目录"""
+    parts = []
+    for part in Path(pattern).parts:
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return Path(*parts) if parts else Path()
+
+
+def iter_directory_inputs(config) -> Iterator[Path]:
+    """
+    遍历 input_dirs 与 input_globs 匹配到的文件
+
+    目录按文件名排序逐层遍历，不会一次性列出整棵目录树；本命令的输出子目录、增量记录目录
+    及隐藏目录中的文件会被跳过，glob 匹配到的文件同样如此。
+    """
+    from incremental import INCREMENTAL_DIR
+
+    output_path = Path(config.output_path).resolve()
+    excluded = [output_path / config.OUTPUT_DIR, output_path / INCREMENTAL_DIR]
+    patterns = [p.lower() for p in config.patterns]
+    for input_dir in config.input_dirs:
+        for root, dirs, files in os.walk(input_dir):
+            root_path = Path(root)
+            dirs[:] = sorted(d for d in dirs if not d.startswith(".")
+                             and not any(_is_within((root_path / d).resolve(), e) for e in excluded))
+            if not config.recursive:
+                dirs.clear()
+            for name in sorted(files):
+                if any(fnmatch(name.lower(), p) for p in patterns):
+                    yield root_path / name
+    for pattern in config.input_globs:
+        root = _glob_root(pattern)
+        for match in sorted(glob.iglob(pattern, recursive=True)):
+            path = Path(match)
+            if not os.path.isfile(match) or any(_is_within(path.resolve(), e) for e in excluded):
+                continue
+            # 与目录遍历一致，跳过通配符匹配到的隐藏目录中的文件
+            if any(part.startswith(".") for part in path.parent.relative_to(root).parts):
+                continue
+            yield path
@@ -0,0 +1,340 @@
+"""
+本地模型仓库: 预先下载或导入超分权重与 rembg 模型，校验后直接从本地加载
+
+目录结构:
+    <model_dir>/ccrestoration/<权重文件名>
+    <model_dir>/rembg/<模型名>.onnx
+    <model_dir>/index.json   已校验文件的 sha256，按文件大小与修改时间缓存，文件未改变时加载不再重新计算
+
+配置了 model_dir 后，首次使用时缺少的模型会下载到仓库中；离线模式(offline)下缺少模型直接报错，
+不会访问网络。仓库目录与离线模式也可以通过环境变量 XINGTU_MODEL_DIR、XINGTU_OFFLINE=1 设置。
+
+用法:
+    python XingTu_core/model_store.py fetch -d models --sr RealESRGAN_AniScale_2_Compact_2x.pth --rembg u2net u2netp
+    python XingTu_core/model_store.py import -d models ~/Downloads/u2net.onnx ~/Downloads/xxx.pth
+    python XingTu_core/model_store.py verify -d models
+"""
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import shutil
+import sys
+import threading
+import uuid
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+from incremental import file_hash
+
+MODEL_DIR_ENV = "XINGTU_MODEL_DIR"
+OFFLINE_ENV = "XINGTU_OFFLINE"
+
+REMBG_HOME_ENV = "U2NET_HOME"
+# 模型仓库相关的环境变量，批处理子进程在创建时继承
+ENV_VARS = (MODEL_DIR_ENV, OFFLINE_ENV, REMBG_HOME_ENV)
+
+_INDEX_FILE = "index.json"
+_SR_DIR = "ccrestoration"
+_REMBG_DIR = "rembg"
+
+# 已打开的仓库，同一进程中的多次加载共用一份校验记录
+_stores: Dict[str, "ModelStore"] = {}
+
+
+class ModelStore:
+    """
+    模型文件目录及其校验记录
+
+    校验记录: 相对路径 -> 大小、修改时间、实际 sha256 及期望的 sha256。
+    超分权重的期望值来自 ccrestoration 的模型配置；rembg 模型在下载(rembg 已校验 md5)或导入时记录。
+    """
+
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root).absolute()
+        self.sr_dir = self.root / _SR_DIR
+        self.rembg_dir = self.root / _REMBG_DIR
+        self.index: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        index_path = self.root / _INDEX_FILE
+        if index_path.is_file():
+            try:
+                with open(index_path, "r", encoding="utf-8") as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"读取模型校验记录失败, 将重新校验: {e}")
+
+    def _save(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        index_path = self.root / _INDEX_FILE
+        tmp_path = index_path.with_name(f"{_INDEX_FILE}.{uuid.uuid4().hex[:8]}.tmp")
+        with self._lock:
+            data = json.dumps(self.index, indent=2)
+        try:
+            tmp_path.write_text(data, encoding="utf-8")
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            print(f"保存模型校验记录失败: {e}")
+            tmp_path.unlink(missing_ok=True)
+
+    def _key(self, path: Path) -> str:
+        return path.relative_to(self.root).as_posix()
+
+    def checksum(self, path: Path, force: bool = False) -> str:
+        """文件的 sha256，大小与修改时间未改变时使用记录中的值"""
+        stat = path.stat()
+        key = self._key(path)
+        entry = self.index.get(key)
+        if (not force and entry is not None and entry["size"] == stat.st_size
+                and entry["mtime_ns"] == stat.st_mtime_ns):
+            return entry["sha256"]
+        digest = file_hash(path)
+        with self._lock:
+            self.index[key] = {**(entry or {}), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                               "sha256": digest}
+        self._save()
+        return digest
+
+    def expect(self, path: Path, sha256: str) -> None:
+        """记录文件的期望 sha256"""
+        self.checksum(path)
+        with self._lock:
+            self.index[self._key(path)]["expected"] = sha256
+        self._save()
+
+    def check(self, path: Path, expected: Optional[str] = None, force: bool = False) -> None:
+        """
+        校验文件，与期望的 sha256 不一致时抛出 ValueError
+
+        :param expected: 期望的 sha256，为空时使用记录中的期望值
+        """
+        digest = self.checksum(path, force)
+        expected = expected or self.index.get(self._key(path), {}).get("expected")
+        if expected is not None and digest != expected:
+            raise ValueError(f"模型文件校验失败: {path}, sha256 {digest} != {expected}")
+
+    # ---------------- 超分权重 ----------------
+
+    def sr_weights(self, name: str, offline: bool = False, gh_proxy: Optional[str] = None) -> str:
+        """
+        返回校验通过的超分权重路径，仓库中没有时下载
+
+        :param name: ccrestoration 的模型名
+        :param offline: 离线模式，仓库中没有时抛出 FileNotFoundError
+        """
+        from ccrestoration.config import CONFIG_REGISTRY
+
+        cfg = CONFIG_REGISTRY.get(name)
+        path = self.sr_dir / cfg.name
+        if not path.is_file():
+            if offline:
+                raise FileNotFoundError(f"离线模式下模型仓库中没有 {cfg.name}, "
+                                        f"请先运行 model_store.py fetch 或 import")
+            self.fetch_sr(name, gh_proxy)
+        self.check(path, cfg.hash)
+        return str(path)
+
+    def fetch_sr(self, name: str, gh_proxy: Optional[str] = None) -> Path:
+        """下载超分权重到仓库(ccrestoration 下载后会校验 sha256)"""
+        from ccrestoration.cache_models import load_file_from_url
+        from ccrestoration.config import CONFIG_REGISTRY
+
+        cfg = CONFIG_REGISTRY.get(name)
+        self.sr_dir.mkdir(parents=True, exist_ok=True)
+        path = Path(load_file_from_url(config=cfg, model_dir=str(self.sr_dir), gh_proxy=gh_proxy))
+        self.expect(path, cfg.hash)
+        return path
+
+    # ---------------- rembg 模型 ----------------
+
+    def use_rembg(self) -> None:
+        """让 rembg 把模型下载到仓库中: 设置 U2NET_HOME"""
+        os.environ[REMBG_HOME_ENV] = str(self.rembg_dir)
+
+    def rembg_model(self, name: str, offline: bool = False) -> str:
+        """
+        返回校验通过的 rembg 模型路径，仓库中没有时下载
+
+        :param offline: 离线模式，仓库中没有时抛出 FileNotFoundError
+        """
+        path = self.rembg_dir / f"{name}.onnx"
+        if not path.is_file():
+            if offline:
+                raise FileNotFoundError(f"离线模式下模型仓库中没有 {path.name}, "
+                                        f"请先运行 model_store.py fetch 或 import")
+            self.fetch_rembg(name)
+        self.check(path)
+        return str(path)
+
+    def fetch_rembg(self, name: str) -> Path:
+        """下载 rembg 模型到仓库(rembg 下载时会校验 md5)"""
+        from rembg.sessions import sessions_class
+
+        session_class = next((sc for sc in sessions_class if sc.name() == name), None)
+        if session_class is None:
+            raise ValueError(f"No session class found for model '{name}'")
+        self.use_rembg()
+        self.rembg_dir.mkdir(parents=True, exist_ok=True)
+        downloaded = Path(session_class.download_models())
+        path = self.rembg_dir / f"{name}.onnx"
+        if downloaded != path:  # 新版本 rembg 下载到 models/<模型名>/ 子目录，统一移动到仓库根目录
+            os.replace(downloaded, path)
+        self.expect(path, file_hash(path))
+        return path
+
+    # ---------------- 导入与校验 ----------------
+
+    def import_file(self, src: Union[str, Path], sha256: Optional[str] = None) -> Path:
+        """
+        导入本地模型文件: ccrestoration 中注册的权重按其 sha256 校验，.onnx 文件作为 rembg 模型
+
+        :param sha256: rembg 模型的期望 sha256，为空时信任导入的文件
+        """
+        from ccrestoration.config import CONFIG_REGISTRY
+
+        src = Path(src)
+        digest = file_hash(src)
+        try:
+            cfg = CONFIG_REGISTRY.get(src.name)
+        except Exception:
+            cfg = None
+        if cfg is not None:
+            expected, dest = cfg.hash, self.sr_dir / cfg.name
+        elif src.suffix.lower() == ".onnx":
+            expected, dest = sha256 or digest, self.rembg_dir / src.name
+        else:
+            raise ValueError(f"无法识别的模型文件: {src.name}")
+        if digest != expected:
+            raise ValueError(f"模型文件校验失败: {src}, sha256 {digest} != {expected}")
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = dest.with_name(f"{dest.name}.{uuid.uuid4().hex[:8]}.tmp")
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dest)
+        self.expect(dest, expected)
+        return dest
+
+    def files(self) -> List[Path]:
+        return sorted(p for d in (self.sr_dir, self.rembg_dir) if d.is_dir()
+                      for p in d.iterdir() if p.is_file() and not p.name.endswith(".tmp"))
+
+    def verify(self) -> List[str]:
+        """重新计算仓库中所有文件的 sha256，返回校验失败的信息"""
+        errors = []
+        for path in self.files():
+            try:
+                self.check(path, force=True)
+            except ValueError as e:
+                errors.append(str(e))
+        return errors
+
+
+def configure(model_dir: Optional[Union[str, Path]], offline: bool = False) -> None:
+    """设置模型仓库目录及离线模式，通过环境变量传给批处理子进程；未设置的项保持不变"""
+    if model_dir is not None:
+        os.environ[MODEL_DIR_ENV] = str(Path(model_dir).absolute())
+    if offline:
+        os.environ[OFFLINE_ENV] = "1"
+
+
+@contextmanager
+def settings(model_dir: Optional[Union[str, Path]], offline: bool = False) -> Iterator[None]:
+    """
+    在一次命令执行期间应用模型仓库目录与离线模式，结束后恢复原来的环境变量
+
+    常驻服务模式下各请求的设置互不影响；启动进程时已设置的环境变量作为默认值保留。
+    """
+    saved = {name: os.environ.get(name) for name in ENV_VARS}
+    configure(model_dir, offline)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def offline() -> bool:
+    return os.environ.get(OFFLINE_ENV) == "1"
+
+
+def current_store() -> Optional[ModelStore]:
+    """当前配置的模型仓库，未配置时返回 None"""
+    root = os.environ.get(MODEL_DIR_ENV)
+    if not root:
+        return None
+    if root not in _stores:
+        _stores[root] = ModelStore(root)
+    return _stores[root]
+
+
+def _require_store() -> Optional[ModelStore]:
+    store = current_store()
+    if store is None and offline():
+        raise ValueError(f"离线模式需要设置模型仓库目录(model_dir 或环境变量 {MODEL_DIR_ENV})")
+    return store
+
+
+def sr_weights(name: str, gh_proxy: Optional[str] = None) -> Optional[str]:
+    """
+    从模型仓库获取超分权重路径
+
+    :return: 未配置模型仓库时返回 None，由 ccrestoration 自行下载及校验
+    """
+    store = _require_store()
+    if store is None:
+        return None
+    return store.sr_weights(name, offline(), gh_proxy)
+
+
+def prepare_rembg(name: str) -> Optional[str]:
+    """
+    创建 rembg 会话前调用: 确保仓库中有按仓库校验记录校验通过的模型
+
+    会话需直接从返回的路径创建(见 remove_bg.get_session)，不经过 rembg 的下载函数:
+    rembg 按内置的 md5 校验，导入的自定义或更新的模型会被重新下载。
+
+    :return: 模型路径，未配置模型仓库时返回 None
+    """
+    store = _require_store()
+    if store is None:
+        return None
+    return store.rembg_model(name, offline())
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="XingTu-core 本地模型仓库")
+    parser.add_argument("-d", "--dir", default=os.environ.get(MODEL_DIR_ENV),
+                        required=not os.environ.get(MODEL_DIR_ENV), help=f"模型仓库目录，默认使用环境变量 {MODEL_DIR_ENV}")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    fetch_parser = subparsers.add_parser("fetch", help="下载模型到仓库")
+    fetch_parser.add_argument("--sr", nargs="*", default=[], help="ccrestoration 模型名")
+    fetch_parser.add_argument("--rembg", nargs="*", default=[], help="rembg 模型名")
+    fetch_parser.add_argument("--gh-proxy", help="GitHub release 下载代理")
+    import_parser = subparsers.add_parser("import", help="导入本地模型文件")
+    import_parser.add_argument("files", nargs="+")
+    import_parser.add_argument("--sha256", help="rembg 模型的期望 sha256(仅导入单个文件时使用)")
+    subparsers.add_parser("verify", help="重新校验仓库中的所有模型文件")
+    args = parser.parse_args()
+
+    store = ModelStore(args.dir)
+    if args.action == "fetch":
+        for name in args.sr:
+            print(f"已下载: {store.fetch_sr(name, args.gh_proxy)}")
+        for name in args.rembg:
+            print(f"已下载: {store.fetch_rembg(name)}")
+    elif args.action == "import":
+        for file in args.files:
+            print(f"已导入: {store.import_file(file, args.sha256 if len(args.files) == 1 else None)}")
+    else:
+        errors = store.verify()
+        for error in errors:
+            print(error, file=sys.stderr)
+        print(f"校验完成: {len(store.files())} 个文件, 失败 {len(errors)} 个")
+        return 1 if errors else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
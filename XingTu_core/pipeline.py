@@ -0,0 +1,145 @@
+from PIL import Image
+from typing import BinaryIO, List, Optional, Union
+import os
+import sys
+import uuid
+
+from config import XTConfig, PipelineStage
+from batch import BatchReport, run_batch
+from cache import ResultCache, open_cache
+from incremental import open_incremental
+from planner import open_planner
+import events
+from resize import decode_reduced
+
+
+def generate_unique_hash():
+    """生成8位唯一哈希值"""
+    return uuid.uuid4().hex[:8]
+
+
+def output_formats(stages: List[PipelineStage]) -> List[str]:
+    """流水线输出文件的格式，由最后一个 format/compress 阶段决定，否则为 png"""
+    last = stages[-1]
+    if last.command == "format":
+        return [t.format.lower() for t in last.get_targets()]
+    if last.command == "compress":
+        return [last.target_format.lower()]
+    return ["png"]
+
+
+def apply_stage(img: Image.Image, stage: PipelineStage) -> Image.Image:
+    """在内存中对图片执行一个 remove_bg 或 final2x 阶段"""
+    if stage.command == "remove_bg":
+        from remove_bg import remove_background, parse_bg_color, predict_mask
+        if stage.mask_only:
+            return predict_mask(img, stage.model or "u2net", stage.session)
+        return remove_background(img, stage.model or "u2net", parse_bg_color(stage.get_bg_colors()[0]),
+                                 stage.session)
+    if stage.command == "final2x":
+        from final2x import upscale_pil
+        return upscale_pil(img, stage)
+    raise ValueError(f"{stage.command} stage must be the last stage of a pipeline")
+
+
+def save_output(img: Image.Image, output_files: List[Union[str, BinaryIO]], stages: List[PipelineStage]) -> None:
+    """按最后一个阶段编码保存，中间结果不落盘，输出可以是文件路径或二进制缓冲"""
+    last = stages[-1]
+    if last.command == "format":
+        from format import save_targets
+        save_targets(img, output_files, last.get_targets())
+    elif last.command == "compress":
+        from compress import save_compressed
+        save_compressed(img, output_files[0], last.target_format, last.quality, last.target_size_kb)
+    else:
+        img.save(output_files[0], format="PNG")
+
+
+def process_image(img: Image.Image, output_files: List[Union[str, BinaryIO]], stages: List[PipelineStage],
+                  bytes_in: Optional[int] = None) -> None:
+    """
+    对已打开的图片依次执行各个阶段并编码输出
+    :param img: 打开的图片，尚未解码
+    :param output_files: 输出文件路径或二进制缓冲，与 output_formats(stages) 一一对应
+    :param stages: 流水线阶段
+    :param bytes_in: 输入字节数，用于记录 decode 阶段
+    """
+    # 最后的 format/compress 阶段限制了输出尺寸时，只有这一个阶段的流水线可以在解码时直接缩小，
+    # 否则在编码前缩小
+    max_size = getattr(stages[-1], "max_size", None)
+    with events.stage("decode", bytes_in=bytes_in):
+        img = decode_reduced(img, max_size if len(stages) == 1 else None)
+    for stage in stages:
+        if stage.command in ("format", "compress"):
+            break
+        with events.stage("inference", step=stage.command):
+            img = apply_stage(img, stage)
+    if max_size is not None and len(stages) > 1:
+        img = decode_reduced(img, max_size)
+    if stages[-1].command == "format":
+        save_output(img, output_files, stages)  # 每个目标格式分别记录 encode 阶段
+    else:
+        with events.stage("encode") as record:
+            save_output(img, output_files, stages)
+            record["bytes_out"] = sum(events.output_size(f) or 0 for f in output_files)
+
+
+def pipeline_image(input_path: str, output_path: str, stages: List[PipelineStage],
+                   cache: Optional[ResultCache] = None) -> Optional[List[str]]:
+    """
+    对单张图片依次执行流水线中的各个阶段，只解码一次，最后一个阶段可以输出多个格式
+    :param input_path: 输入图片路径
+    :param output_path: 输出目录
+    :param stages: 流水线阶段
+    :param cache: 结果缓存，命中时直接复制缓存的结果
+    :return: 成功返回输出文件路径列表，失败返回None
+    """
+    try:
+        base_name = os.path.splitext(os.path.basename(input_path))[0]
+        output_files = [os.path.join(output_path, f"{base_name}_{generate_unique_hash()}.{ext}")
+                        for ext in output_formats(stages)]
+
+        cache_keys = []
+        if cache is not None:
+            with open(input_path, "rb") as f:
+                data = f.read()
+            params = {"stages": [s.model_dump(mode="json") for s in stages]}
+            cache_keys = [cache.make_key("pipeline", {**params, "output": i}, data=data)
+                          for i in range(len(output_files))]
+            if all(cache.get(key, f) for key, f in zip(cache_keys, output_files)):
+                print(f"命中缓存, 图片保存至: {', '.join(output_files)}")
+                return output_files
+
+        with Image.open(input_path) as img:
+            process_image(img, output_files, stages, os.path.getsize(input_path))
+
+        print(f"图片保存至: {', '.join(output_files)}")
+        for key, output_file in zip(cache_keys, output_files):
+            cache.put(key, output_file)
+        return output_files
+    except Exception as e:
+        print(f"处理图片出错: {str(e)}", file=sys.stderr)
+        return None
+
+
+def prepare_stages(stages: List[PipelineStage]) -> None:
+    """超分倍率需要读取模型配置，在主进程中解析一次后随阶段参数传给各任务"""
+    for stage in stages:
+        if stage.command == "final2x":
+            from final2x import resolve_scale
+            resolve_scale(stage)
+
+
+def pipeline_process(config: XTConfig) -> BatchReport:
+    if config.pipelineConfig is None:
+        return False
+    pipeline_config = config.pipelineConfig
+    prepare_stages(pipeline_config.stages)
+
+    output_path = pipeline_config.output_path.joinpath(pipeline_config.OUTPUT_DIR)
+    output_path.mkdir(parents=True, exist_ok=True)
+    cache = open_cache(pipeline_config)
+    tasks = ((pipeline_image, str(input_path), (str(output_path), pipeline_config.stages, cache))
+             for input_path in pipeline_config.iter_inputs())
+    return run_batch("pipeline", tasks, pipeline_config.workers, open_incremental("pipeline", pipeline_config),
+                     open_planner("pipeline", pipeline_config), pipeline_config.input_total())
@@ -0,0 +1,161 @@
+from typing import Any, Optional
+import math
+import threading
+
+from PIL import Image
+from pydantic import BaseModel
+
+# 内存规划: 处理前只读取图片文件头得到尺寸，估算每个任务解码及推理的内存峰值，
+# 调度时保证同时运行的任务预计内存之和不超过 memory_budget_mb。
+# 估算偏保守，只用于调度，不限制实际分配。
+
+# 超分推理每个输入像素的内存峰值: 特征图(约 64 通道 float32，同时存在多个)
+FEATURE_BYTES_PER_PIXEL = 64 * 4 * 8
+# 超分推理每个输出像素的内存峰值: float32 RGB 输出及转换过程中的副本
+OUTPUT_BYTES_PER_PIXEL = 3 * 4 * 4
+# 未设置 tile_size 时由 ccrestoration 分块推理，每块 128x128，四周各扩展 8 像素
+CC_TILE_SIZE = 128
+CC_TILE_PAD = 8
+
+# 各命令相对解码后图片大小的内存倍数: 解码结果、模式转换、编码缓冲等同时存在的副本
+_COPIES = {
+    "format": 3,
+    "compress": 4,  # 按目标大小搜索质量时保留多次编码的结果
+    "remove_bg": 6,  # RGBA 转换、蒙版、抠图及背景色合成
+}
+
+_MB = 1024 * 1024
+
+
+class ImageHeader(BaseModel):
+    width: int
+    height: int
+    bands: int
+    frames: int = 1
+
+    @property
+    def pixels(self) -> int:
+        return self.width * self.height
+
+    @property
+    def decoded_bytes(self) -> int:
+        """Pillow 解码后的大小: 多通道图片每像素按 4 字节存储"""
+        return self.pixels * (4 if self.bands > 1 else 1)
+
+
+def read_header(path: Any) -> Optional[ImageHeader]:
+    """只读取文件头获取尺寸与通道数，不解码像素，无法识别时返回 None"""
+    try:
+        with Image.open(path) as img:
+            return ImageHeader(width=img.width, height=img.height, bands=len(img.getbands()),
+                               frames=getattr(img, "n_frames", 1))
+    except Exception:
+        return None
+
+
+def final2x_bytes(header: ImageHeader, options: Any) -> int:
+    """
+    超分一张图片的内存峰值估算
+
+    特征图只按实际送入模型的块计算: 未设置 tile_size 时为 ccrestoration 的分块(含扩展)，
+    否则为 tiled_inference 的分块
+
+    :param options: Final2xOptions，需已解析 target_scale / cc_model_scale
+    """
+    scale = float(options.cc_model_scale or options.target_scale or 4)
+    target = float(options.target_scale or scale)
+    tile = options.tile_size
+    if tile == "auto":
+        tile = 512  # 与自动选择在内存未知时的默认值一致
+    if tile is None:
+        infer_pixels = (CC_TILE_SIZE + 2 * CC_TILE_PAD) ** 2
+        # ccrestoration 把各块写入整张 float32 输出张量，再整体转换为 uint8
+        output_pixels = header.pixels * scale * scale
+        blend = 0.0
+    else:
+        infer_pixels = min(header.pixels, int(tile) ** 2)
+        output_pixels = infer_pixels * scale * scale
+        # tiled_inference 按行混合，float32 缓冲(各通道及权重)只有一行分块高
+        blend = 0.0 if header.pixels <= infer_pixels else \
+            min(header.height, int(tile)) * header.width * scale * scale * (header.bands + 1) * 4
+    inference = infer_pixels * FEATURE_BYTES_PER_PIXEL + output_pixels * OUTPUT_BYTES_PER_PIXEL + blend
+    # 输入与输出图片(uint8)，带透明通道时 RGB 与透明通道分别推理
+    passes = 2 if header.bands == 4 and options.alpha_mode != "interpolate" else 1
+    images = header.pixels * header.bands * (1 + target * target) * passes
+    return int(inference + images)
+
+
+def estimate_bytes(command: str, header: ImageHeader, options: Any) -> int:
+    """
+    估算处理一张图片的内存峰值(字节)
+
+    :param command: format / compress / remove_bg / final2x / pipeline
+    :param options: 对应命令的配置，pipeline 为 PipelineConfig
+    """
+    if command == "final2x":
+        return final2x_bytes(header, options)
+    if command == "pipeline":
+        peak = 0
+        for stage in options.stages:
+            if stage.command == "final2x":
+                peak = max(peak, final2x_bytes(header, stage))
+                scale = float(stage.target_scale or stage.cc_model_scale or 1)
+                header = ImageHeader(width=math.ceil(header.width * scale),
+                                     height=math.ceil(header.height * scale), bands=header.bands)
+            else:
+                peak = max(peak, estimate_bytes(stage.command, header, stage))
+        return peak
+    # 动画的各帧转换后保留到重新组装，每帧按 RGBA 计算
+    frames = header.pixels * 4 * (header.frames - 1)
+    return header.decoded_bytes * _COPIES[command] + frames
+
+
+class JobPlanner:
+    """按文件头估算各任务的内存，供 batch.run_batch 调度"""
+
+    def __init__(self, command: str, options: Any, budget_mb: int):
+        self.command = command
+        self.options = options
+        self.budget_mb = budget_mb
+
+    def estimate_mb(self, input_path: Any) -> float:
+        """任务的预计内存(MB)，文件头无法读取时为 0(任务会很快失败)"""
+        header = read_header(input_path)
+        if header is None:
+            return 0.0
+        return estimate_bytes(self.command, header, self.options) / _MB
+
+
+def open_planner(command: str, config: Any) -> Optional[JobPlanner]:
+    """根据 BaseConfig 中的 memory_budget_mb 创建任务规划，未配置时返回 None"""
+    if config.memory_budget_mb is None:
+        return None
+    return JobPlanner(command, config, config.memory_budget_mb)
+
+
+class MemoryBudget:
+    """
+    线程间共享的内存预算: acquire 在已占用内存加上本次申请超过预算时阻塞，
+    但没有任何占用时总是允许，保证超出预算的单个任务也能单独运行
+    """
+
+    def __init__(self, budget_mb: float):
+        self.budget_mb = budget_mb
+        self.used_mb = 0.0
+        self.waiting = False  # 是否有线程正在等待释放
+        self._cond = threading.Condition()
+
+    def acquire(self, mb: float) -> None:
+        with self._cond:
+            while self.used_mb > 0 and self.used_mb + mb > self.budget_mb:
+                self.waiting = True
+                self._cond.wait()
+            self.waiting = False
+            self.used_mb += mb
+
+    def release(self, mb: float) -> None:
+        if mb <= 0:
+            return
+        with self._cond:
+            self.used_mb = max(0.0, self.used_mb - mb)
+            self._cond.notify_all()
@@ -0,0 +1,138 @@
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+import functools
+import glob
+import json
+import os
+import threading
+import time
+
+# 性能分析: 记录各热点路径的耗时区间，输出 Chrome trace 格式(chrome://tracing、Perfetto 可直接打开)
+#
+# 每个进程把区间缓存在内存中，批处理子进程在每个任务结束后追加写入 <trace>.<pid>.part，
+# 主进程结束时合并为一个 trace 文件。子进程通过环境变量得知是否需要记录。
+PROFILE_ENV = "XINGTU_PROFILE"
+PROFILE_TORCH_ENV = "XINGTU_PROFILE_TORCH"
+
+_events: List[Dict[str, Any]] = []
+_threads: set = set()
+_lock = threading.Lock()
+_trace_path: Optional[str] = None
+
+
+def start(path: str, torch_profile: bool = False) -> None:
+    """
+    开启性能分析
+
+    :param path: trace 文件输出路径
+    :param torch_profile: 同时使用 torch.profiler 记录超分推理，输出到 <path>.torch.json
+    """
+    global _trace_path
+    _trace_path = os.path.abspath(path)
+    for part in glob.glob(glob.escape(_trace_path) + ".*.part"):
+        os.remove(part)
+    os.environ[PROFILE_ENV] = _trace_path
+    if torch_profile:
+        os.environ[PROFILE_TORCH_ENV] = "1"
+
+
+def enabled() -> bool:
+    return PROFILE_ENV in os.environ
+
+
+def torch_enabled() -> bool:
+    return enabled() and os.environ.get(PROFILE_TORCH_ENV) == "1"
+
+
+def _add(event: Dict[str, Any]) -> None:
+    with _lock:
+        tid = event["tid"]
+        if (event["pid"], tid) not in _threads:
+            _threads.add((event["pid"], tid))
+            _events.append({"name": "thread_name", "ph": "M", "pid": event["pid"], "tid": tid,
+                            "args": {"name": threading.current_thread().name}})
+        _events.append(event)
+
+
+def now_us() -> int:
+    """区间起始时间(微秒)，各进程使用同一时钟，合并后可以对齐"""
+    return time.time_ns() // 1000
+
+
+def record(name: str, ts: int, duration: float, args: Dict[str, Any]) -> None:
+    """
+    记录一个已结束的区间
+
+    :param ts: now_us() 得到的起始时间
+    :param duration: 耗时(秒)
+    """
+    _add({
+        "name": name,
+        "cat": "xingtu",
+        "ph": "X",
+        "ts": ts,
+        "dur": duration * 1e6,
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": args,
+    })
+
+
+@contextmanager
+def span(name: str, **args: Any) -> Iterator[None]:
+    """记录一个耗时区间，未开启性能分析时不做任何事"""
+    if not enabled():
+        yield
+        return
+    ts = now_us()
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, ts, time.perf_counter() - start_time, args)
+
+
+def torch_trace_path() -> str:
+    return os.environ[PROFILE_ENV] + ".torch.json"
+
+
+def traced(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """为函数的每次调用记录一个区间"""
+    def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def flush() -> None:
+    """把当前进程记录的区间追加到 <trace>.<pid>.part"""
+    path = os.environ.get(PROFILE_ENV)
+    if path is None:
+        return
+    with _lock:
+        events = _events[:]
+        _events.clear()
+    if not events:
+        return
+    with open(f"{path}.{os.getpid()}.part", "a", encoding="utf-8") as f:
+        for event in events:
+            f.write(json.dumps(event, default=str) + "\n")
+
+
+def stop() -> Optional[str]:
+    """合并各进程记录的区间并写出 trace 文件，返回文件路径"""
+    if _trace_path is None:
+        return None
+    flush()
+    events: List[Dict[str, Any]] = []
+    for part in sorted(glob.glob(glob.escape(_trace_path) + ".*.part")):
+        with open(part, "r", encoding="utf-8") as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+        os.remove(part)
+    with open(_trace_path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    print(f"性能分析结果已保存至: {_trace_path}")
+    return _trace_path
@@ -1,19 +1,73 @@
 from config import XTConfig
-from format import format_progress
-from remove_bg import remove_bg_process
-from compress import compress_process
-from final2x import final2x_progress
+import model_store
+
+# 各命令模块(及其 torch、cv2、rembg 等重量级依赖)只在执行对应命令时才导入，
+# 使用函数内的 import 语句而非 importlib，便于 pyinstaller 静态分析到这些模块
+
+
+def _format(config: XTConfig):
+    from format import format_progress
+    return format_progress(config)
+
+
+def _remove_bg(config: XTConfig):
+    from remove_bg import remove_bg_process
+    return remove_bg_process(config)
+
+
+def _compress(config: XTConfig):
+    from compress import compress_process
+    return compress_process(config)
+
+
+def _final2x(config: XTConfig):
+    from final2x import final2x_progress
+    return final2x_progress(config)
+
+
+def _pipeline(config: XTConfig):
+    from pipeline import pipeline_process
+    return pipeline_process(config)
+
+
+def _stream(config: XTConfig):
+    from stream import stream_process
+    return stream_process(config)
+
+
+COMMANDS = {
+    'format': _format,
+    'remove_bg': _remove_bg,
+    'compress': _compress,
+    'final2x': _final2x,
+    'pipeline': _pipeline,
+    'stream': _stream,
+}
+
+
+def preload(*commands: str) -> None:
+    """预先导入指定命令(默认全部)的模块，常驻服务模式下在启动时调用"""
+    if not commands or 'format' in commands:
+        import format  # noqa: F401
+    if not commands or 'remove_bg' in commands:
+        import remove_bg  # noqa: F401
+    if not commands or 'compress' in commands:
+        import compress  # noqa: F401
+    if not commands or 'final2x' in commands:
+        import final2x  # noqa: F401
+    if not commands or 'pipeline' in commands:
+        import pipeline  # noqa: F401
+    if not commands or 'stream' in commands:
+        import stream  # noqa: F401
 
 
 def progress(config: XTConfig):
-    if config.command == 'format':
-        return format_progress(config)
-    elif config.command == 'remove_bg':
-        return remove_bg_process(config)
-    elif config.command == 'compress':
-        return compress_process(config)
-    elif config.command == 'final2x':
-        return final2x_progress(config)
-    else:
+    handler = COMMANDS.get(config.command)
+    if handler is None:
         print('Invalid command')
         return 0
+    command_config = config.get_command_config()
+    if command_config is None:
+        return handler(config)
+    with model_store.settings(command_config.model_dir, command_config.offline):
+        return handler(config)
@@ -1,10 +1,103 @@
-from rembg import remove, new_session
+from rembg import remove
+from rembg.bg import apply_background_color, fix_image_orientation, naive_cutout
+from rembg.sessions import sessions_class
+from rembg.sessions.base import BaseSession
 from PIL import Image
+from collections import OrderedDict
+from typing import Optional, Tuple
+import onnxruntime as ort
+import io
 import uuid
 import os
-import sys
 
-from config import XTConfig
+from config import XTConfig, RembgSessionConfig
+from batch import run_batch
+from cache import open_cache
+from incremental import open_incremental
+from planner import open_planner
+from model_store import prepare_rembg
+from events import stage
+from profiler import span
+
+_GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+_EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+# 已加载的 rembg 会话 LRU 缓存: (模型名, 会话参数) -> (会话, 模型文件大小)
+# 避免每张图片都重新加载 ONNX 模型
+_sessions: "OrderedDict[Tuple, Tuple[BaseSession, int]]" = OrderedDict()
+
+
+def build_session_options(options: RembgSessionConfig) -> ort.SessionOptions:
+    """根据配置生成 onnxruntime 会话参数"""
+    sess_opts = ort.SessionOptions()
+    # 与 rembg.new_session 保持一致: 未显式配置线程数时沿用 OMP_NUM_THREADS
+    if "OMP_NUM_THREADS" in os.environ:
+        threads = int(os.environ["OMP_NUM_THREADS"])
+        sess_opts.inter_op_num_threads = threads
+        sess_opts.intra_op_num_threads = threads
+    if options.intra_op_num_threads is not None:
+        sess_opts.intra_op_num_threads = options.intra_op_num_threads
+    if options.inter_op_num_threads is not None:
+        sess_opts.inter_op_num_threads = options.inter_op_num_threads
+    sess_opts.graph_optimization_level = _GRAPH_OPTIMIZATION_LEVELS[options.graph_optimization_level]
+    sess_opts.execution_mode = _EXECUTION_MODES[options.execution_mode]
+    return sess_opts
+
+
+def _model_file_size(session_class, model_path: Optional[str] = None) -> int:
+    """估算会话占用的内存: 使用模型文件大小"""
+    model_file = model_path or os.path.join(session_class.u2net_home(), f"{session_class.name()}.onnx")
+    return os.path.getsize(model_file) if os.path.isfile(model_file) else 0
+
+
+def _session_from_path(session_class, model_path: str):
+    """从指定的模型文件创建会话的会话类，不调用 rembg 的下载与 md5 校验"""
+    return type(session_class.__name__, (session_class,),
+                {"download_models": classmethod(lambda cls, *args, **kwargs: model_path)})
+
+
+def _evict_sessions(options: RembgSessionConfig) -> None:
+    cap = options.cache_memory_mb * 1024 * 1024 if options.cache_memory_mb else None
+    while len(_sessions) > 1 and (len(_sessions) > options.cache_size or
+                                  (cap is not None and sum(size for _, size in _sessions.values()) > cap)):
+        key, _ = _sessions.popitem(last=False)
+        model = key[0]
+        print(f"释放 rembg 会话: {model}")
+
+
+def get_session(model: str, options: Optional[RembgSessionConfig] = None) -> BaseSession:
+    """获取(或创建)指定模型的 rembg 会话"""
+    if options is None:
+        options = RembgSessionConfig()
+    model_path = prepare_rembg(model)  # 模型仓库中的模型，未配置仓库时为 None
+    key = (model, model_path, options.intra_op_num_threads, options.inter_op_num_threads,
+           options.graph_optimization_level, options.execution_mode)
+    if key in _sessions:
+        _sessions.move_to_end(key)
+        return _sessions[key][0]
+
+    session_class = next((sc for sc in sessions_class if sc.name() == model), None)
+    if session_class is None:
+        raise ValueError(f"No session class found for model '{model}'")
+    if model_path is not None:
+        session_class = _session_from_path(session_class, model_path)
+    with span("rembg new session", model=model):
+        session = session_class(model, build_session_options(options))
+    if options.warmup:
+        with span("rembg warmup", model=model):
+            session.predict(Image.new("RGB", (320, 320)))
+    _sessions[key] = (session, _model_file_size(session_class, model_path))
+    _evict_sessions(options)
+    return session
 
 
 def generate_unique_hash():
@@ -12,70 +105,186 @@ def generate_unique_hash():
     return uuid.uuid4().hex[:8]  # 使用8位哈希值，可以根据需要调整长度
 
 
-def process_image(input_path, output_path=None, bg_color=None, model=None):
+def parse_bg_color(bg_color):
+    """
+    解析十六进制背景颜色
+
+    Args:
+        bg_color: 形如 "#RRGGBB" 或 "RRGGBB" 的颜色字符串
+
+    Returns:
+        tuple: (r, g, b, 255)，为空或格式错误时返回None(透明背景)
+    """
+    if not bg_color:
+        return None
+    try:
+        # 移除可能的#前缀
+        if bg_color.startswith('#'):
+            bg_color = bg_color[1:]
+
+        # 解析颜色
+        r = int(bg_color[0:2], 16)
+        g = int(bg_color[2:4], 16)
+        b = int(bg_color[4:6], 16)
+
+        print(f"使用背景颜色: RGB({r}, {g}, {b})")
+        return r, g, b, 255
+    except Exception as e:
+        print(f"背景颜色格式错误: {str(e)}，将使用透明背景")
+        return None
+
+
+def predict_mask(image, model="u2net", session_config=None):
+    """
+    预测PIL图片的前景蒙版
+
+    Args:
+        image: 输入的PIL图像对象
+        model: rembg 模型名
+        session_config: RembgSessionConfig，会话缓存及 onnxruntime 参数
+
+    Returns:
+        Image: L 模式的蒙版
+    """
+    session = get_session(model, session_config)
+    return remove(image, session=session, only_mask=True)
+
+
+def composite(image, mask, bgcolor=None):
+    """
+    使用蒙版抠图并合成背景色，与 rembg.remove 的默认处理一致
+
+    Args:
+        image: 输入的PIL图像对象
+        mask: predict_mask 得到的蒙版
+        bgcolor: (r, g, b, a) 背景颜色，None 为透明背景
+
+    Returns:
+        Image: 抠图结果
+    """
+    cutout = naive_cutout(fix_image_orientation(image), mask)
+    if bgcolor is not None:
+        cutout = apply_background_color(cutout, bgcolor)
+    return cutout
+
+
+def remove_background(image, model="u2net", bgcolor=None, session_config=None):
+    """
+    移除PIL图片的背景
+
+    Args:
+        image: 输入的PIL图像对象
+        model: rembg 模型名
+        bgcolor: (r, g, b, a) 背景颜色，None 为透明背景
+        session_config: RembgSessionConfig，会话缓存及 onnxruntime 参数
+
+    Returns:
+        Image: 抠图结果
+    """
+    session = get_session(model, session_config)
+    return remove(image, session=session, bgcolor=bgcolor)
+
+
+def load_mask(input_path, model, session_config=None, cache=None):
+    """
+    获取输入图片的蒙版，配置了缓存时按图片内容与模型缓存蒙版，
+    同一张图片换背景色或重复处理时不需要再次推理
+
+    Returns:
+        (PIL图像对象, 蒙版)
+    """
+    with stage("decode") as record:
+        with open(input_path, 'rb') as f:
+            data = f.read()
+        input_image = Image.open(io.BytesIO(data))
+        input_image.load()
+        record["bytes_in"] = len(data)
+
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.make_key("remove_bg_mask", {"model": model}, data=data)
+        cached = cache.read(cache_key)
+        if cached is not None:
+            print("命中蒙版缓存")
+            return input_image, Image.open(io.BytesIO(cached))
+
+    with stage("inference", model=model):
+        mask = predict_mask(input_image, model, session_config)
+    if cache_key is not None:
+        buffer = io.BytesIO()
+        mask.save(buffer, 'PNG')
+        cache.write(cache_key, buffer.getvalue(), '.png')
+    return input_image, mask
+
+
+def save_cutout(image, output_filename, input_ext):
+    # 处理JPEG保存（不支持透明通道）
+    if input_ext.lower() in ['.jpg', '.jpeg'] and image.mode == 'RGBA':
+        # 创建RGB图像并粘贴RGBA图像
+        rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+        rgb_image.paste(image, mask=image.split()[3])
+        rgb_image.save(output_filename, 'JPEG', quality=95)
+    else:
+        image.save(output_filename)
+
+
+def process_image(input_path, output_path=None, bg_colors=None, model=None, session_config=None, cache=None,
+                  mask_only=False, save_mask=False):
     """
     使用rembg库处理图片，移除背景
 
+    每张图片只推理一次蒙版，再按 bg_colors 合成多张结果
+
     Args:
         input_path: 输入图片路径
-        output_path: 输出图片路径或目录，如果为None则自动生成
+        output_path: 输出目录
+        bg_colors: 背景颜色列表，每种颜色输出一张图片，None 为透明背景
+        model: rembg 模型名
+        session_config: RembgSessionConfig，会话缓存及 onnxruntime 参数
+        cache: ResultCache，用于缓存蒙版
+        mask_only: 只输出蒙版
+        save_mask: 额外输出蒙版
 
     Returns:
-        bool: 处理是否成功
-        :param model:
-        :param input_path:
-        :param output_path:
-        :param bg_color:
+        list: 成功返回输出文件路径列表，失败返回None
     """
     try:
-        # 打开输入图片
-        input_image = Image.open(input_path)
-
         if model is None:
             model = "u2net"
-        session = new_session(model_name=model)
-
-        if bg_color:
-            try:
-                # 移除可能的#前缀
-                if bg_color.startswith('#'):
-                    bg_color = bg_color[1:]
-
-                # 解析颜色
-                r = int(bg_color[0:2], 16)
-                g = int(bg_color[2:4], 16)
-                b = int(bg_color[4:6], 16)
-
-                bgcolor = (r, g, b, 255)
-                print(f"使用背景颜色: RGB({r}, {g}, {b})")
-            except Exception as e:
-                print(f"背景颜色格式错误: {str(e)}，将使用透明背景")
-                bgcolor = None
-
-        # 执行抠图
-        output_image = remove(input_image, session=session, bgcolor=bgcolor)
+        if not bg_colors:
+            bg_colors = [None]
+
         # 获取输入文件的文件名和扩展名
         input_filename, input_ext = os.path.splitext(os.path.basename(input_path))
-        # 生成输出文件名
-        output_filename = os.path.join(output_path, f"{input_filename}_{generate_unique_hash()}{input_ext}")
         # 确保输出目录存在
-        output_dir = os.path.dirname(output_filename)
-        if output_dir and not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        print(f"文件保存至: {output_filename}")
-        # 处理JPEG保存（不支持透明通道）
-        if input_ext.lower() in ['.jpg', '.jpeg'] and output_image.mode == 'RGBA':
-            # 创建RGB图像并粘贴RGBA图像
-            rgb_image = Image.new('RGB', output_image.size, (255, 255, 255))
-            rgb_image.paste(output_image, mask=output_image.split()[3])
-            rgb_image.save(output_filename, 'JPEG', quality=95)
-        else:
-            output_image.save(output_filename)
-
-        return True
+        if output_path and not os.path.exists(output_path):
+            os.makedirs(output_path)
+
+        input_image, mask = load_mask(input_path, model, session_config, cache)
+        output_files = []
+        if mask_only or save_mask:
+            mask_filename = os.path.join(output_path, f"{input_filename}_mask_{generate_unique_hash()}.png")
+            print(f"蒙版保存至: {mask_filename}")
+            with stage("encode", output="mask") as record:
+                mask.save(mask_filename)
+                record["bytes_out"] = os.path.getsize(mask_filename)
+            output_files.append(mask_filename)
+        if mask_only:
+            return output_files
+
+        for bg_color in bg_colors:
+            # 生成输出文件名
+            output_filename = os.path.join(output_path, f"{input_filename}_{generate_unique_hash()}{input_ext}")
+            print(f"文件保存至: {output_filename}")
+            with stage("encode", bg_color=bg_color) as record:
+                output_image = composite(input_image, mask, parse_bg_color(bg_color))
+                save_cutout(output_image, output_filename, input_ext)
+                record["bytes_out"] = os.path.getsize(output_filename)
+            output_files.append(output_filename)
+        return output_files
     except Exception as e:
         print(f"处理图片时发生错误: {e}")
-        return False
+        return None
 
 
 def remove_bg_process(config: XTConfig):
@@ -86,12 +295,17 @@ def remove_bg_process(config: XTConfig):
         config: 配置信息
 
     Returns:
-        bool: 处理是否成功
+        BatchReport: 每个文件的处理结果及吞吐统计
         :param config:
     """
-    output_path = config.removeBgConfig.output_path.joinpath("koutu")
+    remove_bg_config = config.removeBgConfig
+    output_path = remove_bg_config.output_path.joinpath(remove_bg_config.OUTPUT_DIR)
     if not output_path.exists():
         output_path.mkdir(exist_ok=True, parents=True)
-    success = process_image(config.removeBgConfig.input_path[0], output_path, config.removeBgConfig.bg_color,
-                            config.removeBgConfig.model)
-    sys.exit(0 if success else 1)
+    cache = open_cache(remove_bg_config)
+    tasks = ((process_image, str(p),
+              (output_path, remove_bg_config.get_bg_colors(), remove_bg_config.model, remove_bg_config.session, cache,
+               remove_bg_config.mask_only, remove_bg_config.save_mask))
+             for p in remove_bg_config.iter_inputs())
+    return run_batch("remove_bg", tasks, remove_bg_config.workers, open_incremental("remove_bg", remove_bg_config),
+                     open_planner("remove_bg", remove_bg_config), remove_bg_config.input_total())
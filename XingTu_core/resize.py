@@ -0,0 +1,34 @@
+from PIL import Image
+from typing import Optional, Tuple
+
+
+def fit_size(size: Tuple[int, int], max_size: int) -> Tuple[int, int]:
+    """等比缩小到最长边不超过 max_size 后的尺寸"""
+    scale = max_size / max(size)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def decode_reduced(img: Image.Image, max_size: Optional[int] = None) -> Image.Image:
+    """
+    解码图片，最长边超过 max_size 时等比缩小
+
+    JPEG 在解码前调用 draft()，由解码器直接按 1/2、1/4、1/8 进行 DCT 缩放，解码耗时与内存随之减少；
+    其他格式完整解码后先用 reduce() 整数倍缩小，再用 LANCZOS 缩放到目标尺寸(resize 的 reducing_gap)。
+    两种方式都至少保留目标尺寸的两倍再做最终缩放，结果与完整解码后缩放几乎没有差别。
+
+    Args:
+        img: Image.open 打开、尚未解码的图片；已解码的图片同样可以缩小
+        max_size: 最长边上限(像素)，为空时只解码不缩放
+
+    Returns:
+        解码后的图片，缩小时为新的图片对象
+    """
+    if max_size is None or max(img.size) <= max_size:
+        img.load()
+        return img
+    size = fit_size(img.size, max_size)
+    box = None
+    drafted = img.draft(None, (size[0] * 2, size[1] * 2))
+    if drafted is not None:
+        box = drafted[1]  # 原图区域在缩放后图片中的位置
+    return img.resize(size, Image.LANCZOS, box=box, reducing_gap=2.0)
@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+import time
+import traceback
+from typing import Any, IO, Optional
+
+from pydantic import BaseModel
+from config import XTConfig
+from progress import preload, progress
+
+
+def _result_to_json(result: Any) -> Any:
+    if isinstance(result, BaseModel):
+        data = result.model_dump()
+        data["succeeded"] = getattr(result, "succeeded", None)
+        data["failed"] = getattr(result, "failed", None)
+        data["throughput"] = getattr(result, "throughput", None)
+        return data
+    return result
+
+
+def handle_request(line: str) -> dict:
+    """
+    处理一行 JSON 请求
+
+    请求可以直接是 XTConfig，也可以是 {"id": ..., "config": XTConfig}
+    """
+    start = time.perf_counter()
+    request_id: Optional[Any] = None
+    try:
+        payload = json.loads(line)
+        if isinstance(payload, dict) and "config" in payload:
+            request_id = payload.get("id")
+            payload = payload["config"]
+        config = XTConfig(**payload)
+        if config.command == "stream":
+            raise ValueError("stream command cannot be used in server mode")
+        command_config = config.require_command_config()
+        if command_config.manifest == "-":
+            raise ValueError("manifest cannot be read from stdin in server mode")
+        result = progress(config)
+        return {
+            "id": request_id,
+            "success": bool(result),
+            "elapsed": time.perf_counter() - start,
+            "result": _result_to_json(result),
+        }
+    except Exception as e:
+        traceback.print_exc(file=sys.stderr)
+        return {
+            "id": request_id,
+            "success": False,
+            "elapsed": time.perf_counter() - start,
+            "error": str(e),
+        }
+
+
+def serve(stdin: IO[str] = sys.stdin) -> None:
+    """
+    常驻服务模式: 从标准输入逐行读取 JSON 请求，每个请求的结果以一行 JSON 写回标准输出
+
+    处理过程中的普通输出(print、子进程输出)会被重定向到标准错误，保证标准输出只包含协议数据。
+    已加载的超分模型、rembg 会话以及进程池在请求之间保持常驻。
+    """
+    # 在文件描述符层面把 stdout 指向 stderr，子进程同样继承该重定向
+    protocol_out = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8", buffering=1)
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    preload()
+    protocol_out.write(json.dumps({"event": "ready", "pid": os.getpid()}) + "\n")
+    for line in stdin:
+        line = line.strip()
+        if not line:
+            continue
+        response = handle_request(line)
+        sys.stdout.flush()
+        protocol_out.write(json.dumps(response, ensure_ascii=False, default=str) + "\n")
+    protocol_out.close()
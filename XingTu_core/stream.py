@@ -0,0 +1,112 @@
+from PIL import Image
+from typing import BinaryIO, Iterator, List, Optional
+import io
+import os
+import struct
+import sys
+import time
+
+from config import XTConfig, PipelineStage
+from pipeline import output_formats, prepare_stages, process_image
+import events
+
+# 流模式: 图片字节从标准输入读入，处理结果写到标准输出，全程在内存中解码与编码，不经过临时文件。
+#
+# 非分帧模式下标准输入是一张完整的图片，标准输出是编码后的结果(只允许一个输出格式)。
+# 分帧模式下每张图片为一帧: 4 字节大端无符号长度 + 图片数据；每张图片的每个输出格式按相同方式
+# 写出一帧，顺序与 output_formats 一致。处理失败的图片对应的各帧长度为 0，错误信息输出到标准错误。
+# 处理过程中的普通输出(print、进度日志)被重定向到标准错误，标准输出只包含图片数据。
+
+_LENGTH = struct.Struct(">I")
+
+
+def _read_exact(stdin: BinaryIO, size: int) -> bytes:
+    data = stdin.read(size)
+    if len(data) != size:
+        raise ValueError(f"truncated frame: expected {size} bytes, got {len(data)}")
+    return data
+
+
+def read_frames(stdin: BinaryIO) -> Iterator[bytes]:
+    """逐帧读取分帧输入，在帧边界遇到 EOF 时结束"""
+    while True:
+        header = stdin.read(_LENGTH.size)
+        if not header:
+            return
+        if len(header) != _LENGTH.size:
+            raise ValueError("truncated frame header")
+        yield _read_exact(stdin, _LENGTH.unpack(header)[0])
+
+
+def write_frame(stdout: BinaryIO, data: bytes) -> None:
+    stdout.write(_LENGTH.pack(len(data)))
+    stdout.write(data)
+
+
+def process_bytes(data: bytes, stages: List[PipelineStage]) -> List[bytes]:
+    """
+    在内存中处理一张图片
+    :param data: 编码后的图片数据
+    :param stages: 处理阶段
+    :return: 各输出格式编码后的数据，与 output_formats(stages) 一一对应
+    """
+    outputs = [io.BytesIO() for _ in output_formats(stages)]
+    with Image.open(io.BytesIO(data)) as img:
+        process_image(img, outputs, stages, len(data))
+    return [output.getvalue() for output in outputs]
+
+
+def _process(index: int, data: bytes, stages: List[PipelineStage]) -> Optional[List[bytes]]:
+    start = time.perf_counter()
+    error = None
+    results = None
+    with events.collect_stages() as stages_record:
+        try:
+            results = process_bytes(data, stages)
+        except Exception as e:
+            error = str(e)
+            print(f"处理第 {index} 张图片出错: {error}", file=sys.stderr)
+    events.emit("file", command="stream", index=index, success=results is not None, error=error,
+                duration=time.perf_counter() - start, bytes_in=len(data),
+                bytes_out=sum(len(r) for r in results) if results is not None else 0, stages=stages_record)
+    return results
+
+
+def stream_process(config: XTConfig, stdin: Optional[BinaryIO] = None, stdout: Optional[BinaryIO] = None) -> bool:
+    """
+    执行流模式
+
+    :param stdin: 输入流，默认为标准输入
+    :param stdout: 输出流，默认为标准输出；使用标准输出时把文件描述符 1 重定向到标准错误，子进程同样继承
+    :return: 所有图片是否都处理成功
+    """
+    if config.streamConfig is None:
+        return False
+    stream_config = config.streamConfig
+    stages = stream_config.stages
+    if not stream_config.framed and len(output_formats(stages)) > 1:
+        raise ValueError("stream mode without framing accepts a single output format")
+
+    stdin = stdin or sys.stdin.buffer
+    if stdout is None:
+        sys.stdout.flush()
+        stdout = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    prepare_stages(stages)
+    if not stream_config.framed:
+        results = _process(0, stdin.read(), stages)
+        if results is not None:
+            stdout.write(results[0])
+        stdout.flush()
+        return results is not None
+
+    ok = True
+    empty = [b""] * len(output_formats(stages))
+    for index, data in enumerate(read_frames(stdin)):
+        results = _process(index, data, stages)
+        ok = ok and results is not None
+        for result in results if results is not None else empty:
+            write_frame(stdout, result)
+        stdout.flush()  # 每张图片处理完即写出，调用方可以按帧流式读取
+    return ok
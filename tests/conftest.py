@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+CORE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "XingTu_core")
+# XingTu_core 中的模块使用顶层导入(from config import ...)
+sys.path.insert(0, CORE_DIR)
+
+
+@pytest.fixture
+def make_image(tmp_path):
+    """在临时目录中生成指定模式与尺寸的图片，返回路径"""
+
+    def make(name: str = "input.png", mode: str = "RGB", size=(64, 48)) -> str:
+        path = str(tmp_path / name)
+        Image.linear_gradient("L").resize(size).convert(mode).save(path)
+        return path
+
+    return make
@@ -0,0 +1,21 @@
+import numpy as np
+from PIL import Image, ImageStat
+
+from compress import compress_image
+
+
+def test_target_size_png_with_16_bit_input(tmp_path):
+    # 16 位灰度噪声，无损压缩达不到目标大小，需要尝试调色板量化
+    rng = np.random.default_rng(0)
+    input_path = str(tmp_path / "gray16.png")
+    Image.fromarray(rng.integers(0, 65536, (128, 128), dtype=np.uint16)).save(input_path)
+    with Image.open(input_path) as img:
+        assert img.mode in ("I;16", "I")
+
+    output_path = compress_image(input_path, str(tmp_path), "png", target_size_kb=8)
+    assert output_path is not None
+    with Image.open(output_path) as img:
+        assert img.mode == "P"
+        assert img.size == (128, 128)
+        # 量化前按比例缩放到 8 位，而不是把超过 255 的值截断为白色
+        assert 100 < ImageStat.Stat(img.convert("L")).mean[0] < 156
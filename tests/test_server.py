@@ -0,0 +1,26 @@
+import json
+import subprocess
+import sys
+
+from conftest import CORE_DIR
+
+
+def test_missing_command_config_is_an_error():
+    from server import handle_request
+
+    response = handle_request(json.dumps({"command": "format"}))
+    assert response["success"] is False
+    assert "formatConfig" in response["error"]
+
+
+def test_server_exits_on_eof_after_multi_worker_request(tmp_path, make_image):
+    inputs = [make_image("a.png"), make_image("b.png")]
+    request = {"command": "compress",
+               "compressConfig": {"input_path": inputs, "output_path": str(tmp_path), "target_format": "jpg",
+                                  "workers": 2}}
+    proc = subprocess.run([sys.executable, "__main__.py", "--SERVER"], cwd=CORE_DIR,
+                          input=json.dumps(request) + "\n", capture_output=True, text=True, timeout=120)
+    assert proc.returncode == 0, proc.stderr
+    lines = [json.loads(line) for line in proc.stdout.splitlines()]
+    assert lines[0]["event"] == "ready"
+    assert lines[1]["success"] is True